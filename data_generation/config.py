@@ -17,6 +17,10 @@ CAPTION_DIR = os.getenv("Start_CAPTION_DIR", "/path/to/single_video_captions")
 # Path to the directory containing the actual video files (for Step 6)
 VIDEO_ROOT_DIR = os.getenv("Start_VIDEO_ROOT_DIR", "/path/to/video_data/long_video_clip")
 
+# Optional base URL under which VIDEO_ROOT_DIR is served (e.g. a bucket or static file server the VLM
+# provider can fetch from). When set, Step 6 sends clip URLs instead of inline base64 video.
+VIDEO_URL_BASE = os.getenv("Start_VIDEO_URL_BASE", "")
+
 # Model Names
 # Adjust model names based on your deployment
 GENERATION_MODEL = "gpt-5.2"
@@ -28,6 +32,31 @@ VIDEO_VERIFICATION_MODEL = "qwen3-vl-235b-a22b-instruct"
 # Concurrency
 MAX_WORKERS_DEFAULT = 30
 MAX_WORKERS_VIDEO = 8
+# Client-side request budget for the asyncio steps (requests per minute)
+REQUESTS_PER_MINUTE = 500
+# Client-side token budget (prompt estimate + max_tokens per request, tokens per minute)
+TOKENS_PER_MINUTE = 2_000_000
+# Base retry wait in seconds; doubled per attempt for server/connection errors unless the server sends retry-after
+RETRY_BASE_DELAY = 2
+
+# Provider Batch API (used by steps that opt in; requests per uploaded batch file, status poll interval)
+BATCH_MAX_REQUESTS = 50000
+BATCH_POLL_SECONDS = 60
+# HTTP connection pool of the shared LLM client (HTTP/2 multiplexes requests over kept-alive connections)
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") != "0"
+HTTP_MAX_CONNECTIONS = max(256, MAX_WORKERS_DEFAULT * 4)
+HTTP_MAX_KEEPALIVE = max(128, MAX_WORKERS_DEFAULT * 2)
+HTTP_TIMEOUTS = {"connect": 5.0, "read": 120.0, "write": 10.0, "pool": 60.0}
+
+# LLM Response Cache
+# Validated responses are stored on disk keyed by a hash of (model, messages, params),
+# so reruns after partial failures skip requests that already succeeded.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") != "0"
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "results/.cache")
+LLM_CACHE_MEMORY_SIZE = 8192
+# Requests sampled above this temperature are never cached (e.g. Step 1 generation),
+# so reruns still draw fresh samples; verification calls (<= 0.1) are always reused.
+LLM_CACHE_MAX_TEMPERATURE = 0.3
 
 def validate_config():
     """Validates that necessary configuration is set."""
@@ -0,0 +1,65 @@
+import os
+import json
+import orjson
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+import config
+
+# ================= LLM Response Cache =================
+# Content-addressed cache: the key hashes everything that determines a response
+# (model, messages, sampling params), so reruns reuse answers at request granularity.
+
+_MEMORY = OrderedDict()
+_MEMORY_LOCK = threading.Lock()
+
+def make_key(model, messages, **params):
+    """Returns a stable hex digest for an LLM request, or None if sampling is too random to reuse."""
+    if params.get("temperature", 0) > config.LLM_CACHE_MAX_TEMPERATURE: return None
+    payload = json.dumps({"model": model, "messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=32).hexdigest()
+
+def _cache_path(key):
+    return os.path.join(config.LLM_CACHE_DIR, key[:2], f"{key}.json")
+
+def _remember(key, content):
+    with _MEMORY_LOCK:
+        _MEMORY[key] = content
+        _MEMORY.move_to_end(key)
+        while len(_MEMORY) > config.LLM_CACHE_MEMORY_SIZE:
+            _MEMORY.popitem(last=False)
+
+def get(key):
+    """Returns the cached response text for `key`, or None on a miss."""
+    if not config.LLM_CACHE_ENABLED or key is None: return None
+    with _MEMORY_LOCK:
+        if key in _MEMORY:
+            _MEMORY.move_to_end(key)
+            return _MEMORY[key]
+
+    path = _cache_path(key)
+    if not os.path.exists(path): return None
+    try:
+        with open(path, 'rb') as f:
+            content = orjson.loads(f.read()).get("content")
+    except Exception as e:
+        logging.warning(f"⚠️ Ignoring unreadable cache entry {path}: {e}")
+        return None
+    if content is not None:
+        _remember(key, content)
+    return content
+
+def put(key, content):
+    """Stores a response; written via a temp file so concurrent readers never see partial entries."""
+    if not config.LLM_CACHE_ENABLED or key is None or content is None: return
+    _remember(key, content)
+    path = _cache_path(key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps({"content": content}))
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.warning(f"⚠️ Failed to write cache entry {path}: {e}")
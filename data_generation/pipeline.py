@@ -0,0 +1,129 @@
+import os
+import asyncio
+from utils import setup_logger, save_json, get_rate_limiters, load_captions_map, BufferedLogger, ResultStore
+import config
+import step2_deduplication as step2
+import step3_leakage_check as step3
+import step4_logic_check as step4
+
+# ================= Configuration =================
+# Fused Steps 2-4: the Step 1 result store is read once, deduplicated, leakage-checked and
+# logic-checked in memory, and only the final Step 4 results are written.
+INPUT_STORE_FILE = step2.INPUT_STORE_FILE    # Input from Step 1
+OUTPUT_DIR = step4.OUTPUT_DIR                # Same layout Step 5 reads from
+LOG_DIR = "results/pipeline_steps2to4"
+CAPTION_DIR = config.CAPTION_DIR
+MAX_WORKERS = config.MAX_WORKERS_DEFAULT
+# =============================================
+
+logger = setup_logger("Pipeline_Steps2to4", LOG_DIR)
+
+def load_and_dedup(video_id, candidates):
+    """Stage 1: apply the Step 2 filter in memory to one video's Step 1 QAs."""
+    local_logger = BufferedLogger(logger, prefix=f"[{video_id}] ")
+
+    if not candidates:
+        local_logger.flush()
+        return None
+
+    valid_qas, failed_qas = step2.dedup_filter(candidates, local_logger)
+    local_logger.info(f"🧹 Dedup retention: {len(valid_qas)}/{len(candidates)}")
+    local_logger.flush()
+    return {"video_id": video_id, "valid": valid_qas, "failed": failed_qas, "total": len(candidates)}
+
+async def run_leakage_stage(videos, limiters):
+    """
+    Stage 2: leakage-check every surviving QA across all videos in shared batches.
+    Leaking QAs are moved to their video's failed list. Returns the ids of videos whose
+    batches could not be checked; those are left unwritten so a rerun retries them.
+    """
+    refs = {}
+    llm_qas = []
+    bad_ids = set()
+    global_id = 1
+    for vi, video in enumerate(videos):
+        for qa in video["valid"]:
+            question = qa.get('question', '').strip()
+            answer = qa.get('answer', '').strip()
+            refs[global_id] = vi
+            if step3.is_obvious_leak(question, answer):
+                bad_ids.add(global_id)
+            else:
+                llm_qas.append({"id": global_id, "question": question, "answer": answer})
+            global_id += 1
+
+    batches = [llm_qas[i:i + step3.BATCH_SIZE] for i in range(0, len(llm_qas), step3.BATCH_SIZE)]
+    logger.info(f"🔎 Leakage check: {len(llm_qas)} QAs in {len(batches)} batches ({len(bad_ids)} flagged by the local screen).")
+    results = await asyncio.gather(*(step3.check_batch_with_retry(bid, b, limiters) for bid, b in enumerate(batches)))
+
+    unchecked_videos = set()
+    for batch, result in zip(batches, results):
+        if result is None:
+            unchecked_videos.update(refs[qa['id']] for qa in batch)
+        else:
+            batch_ids = {qa['id'] for qa in batch}
+            bad_ids.update(x for x in result if x in batch_ids)
+
+    global_id = 1
+    for vi, video in enumerate(videos):
+        kept = []
+        for qa in video["valid"]:
+            if global_id in bad_ids:
+                qa['failure_reason'] = "Leakage: answer is given away by the question"
+                video["failed"].append(qa)
+            else:
+                kept.append(qa)
+            global_id += 1
+        video["valid"] = kept
+
+    logger.info(f"🔎 Leakage check flagged {len(bad_ids)} QAs in total.")
+    return {videos[vi]["video_id"] for vi in unchecked_videos}
+
+async def run_logic_stage(video, limiters):
+    """Stage 3: logic-check one video's remaining QAs and write the final results."""
+    video_id = video["video_id"]
+    output_file = os.path.join(OUTPUT_DIR, f"{video_id}_passed_logic_check.json")
+    failed_file = os.path.join(OUTPUT_DIR, f"{video_id}_failed_fused_check.json")
+    local_logger = BufferedLogger(logger, prefix=f"[{video_id}] ")
+
+    caption_file = os.path.join(CAPTION_DIR, f"{video_id}.json")
+    caption_map = await asyncio.to_thread(load_captions_map, caption_file)
+    if not caption_map:
+        local_logger.warning(f"⚠️ No captions found at {caption_file}, skipping.")
+        local_logger.flush()
+        return
+
+    passed_qas, logic_failed = await step4.verify_qas(video["valid"], caption_map, limiters, local_logger)
+    failed_qas = video["failed"] + logic_failed
+
+    await asyncio.to_thread(save_json, passed_qas, output_file)
+    if failed_qas:
+        await asyncio.to_thread(save_json, failed_qas, failed_file)
+        local_logger.info(f"📉 Saved {len(failed_qas)} failed questions to: {failed_file}")
+
+    local_logger.info(f"🎉 Done. Retention rate: {len(passed_qas)}/{video['total']}")
+    local_logger.flush()
+
+async def main():
+    store = await asyncio.to_thread(ResultStore, INPUT_STORE_FILE, step2.LEGACY_SUFFIX)
+    target_ids = [vid for vid in store.video_ids()
+                  if not os.path.exists(os.path.join(OUTPUT_DIR, f"{vid}_passed_logic_check.json"))]
+
+    logger.info(f"🎯 Fused Steps 2-4 processing {len(target_ids)} videos with {MAX_WORKERS} concurrent requests")
+
+    loaded = [load_and_dedup(vid, store.get(vid)) for vid in target_ids]
+    videos = [v for v in loaded if v]
+
+    limiters = get_rate_limiters(MAX_WORKERS)
+    unchecked = await run_leakage_stage(videos, limiters)
+    if unchecked:
+        logger.error(f"❌ Leakage check failed for {len(unchecked)} videos; they will be retried on the next run: {sorted(unchecked)}")
+
+    ready = [v for v in videos if v["video_id"] not in unchecked]
+    results = await asyncio.gather(*(run_logic_stage(v, limiters) for v in ready), return_exceptions=True)
+    for video, res in zip(ready, results):
+        if isinstance(res, Exception):
+            logger.error(f"❌ Unhandled error for {video['video_id']}: {res}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
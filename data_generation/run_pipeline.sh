@@ -10,24 +10,33 @@ echo "Running Step 1: QA Generation"
 echo "========================================="
 python3 step1_qa_generation.py
 
-# Step 2: Deduplication
-echo "========================================="
-echo "Running Step 2: Deduplication"
-echo "========================================="
-python3 step2_deduplication.py
-
-# Step 3: Leakage Check (New step inserted)
-# Extracts candidates, checks with API, and removes leaking QAs
-echo "========================================="
-echo "Running Step 3: Leakage Check & Cleaning"
-echo "========================================="
-python3 step3_leakage_check.py
-
-# Step 4: Logic Check
-echo "========================================="
-echo "Running Step 4: Logic Check"
-echo "========================================="
-python3 step4_logic_check.py
+# Steps 2-4 can run fused (FUSED_STEPS=1): each Step 1 file is read once and only
+# the final Step 4 results are written, skipping the intermediate Step 2/3 files.
+if [ "${FUSED_STEPS:-0}" = "1" ]; then
+    echo "========================================="
+    echo "Running Steps 2-4 (Fused): Deduplication, Leakage Check, Logic Check"
+    echo "========================================="
+    python3 pipeline.py
+else
+    # Step 2: Deduplication
+    echo "========================================="
+    echo "Running Step 2: Deduplication"
+    echo "========================================="
+    python3 step2_deduplication.py
+
+    # Step 3: Leakage Check (New step inserted)
+    # Extracts candidates, checks with API, and removes leaking QAs
+    echo "========================================="
+    echo "Running Step 3: Leakage Check & Cleaning"
+    echo "========================================="
+    python3 step3_leakage_check.py
+
+    # Step 4: Logic Check
+    echo "========================================="
+    echo "Running Step 4: Logic Check"
+    echo "========================================="
+    python3 step4_logic_check.py
+fi
 
 # Step 5: Necessity Check
 echo "========================================="
@@ -1,36 +1,39 @@
 import os
 import glob
+import re
 import json
-import concurrent.futures
-from utils import setup_logger, get_openai_client, call_llm_with_retry, save_json, load_json, validate_json_list, BufferedLogger
+import orjson
+import asyncio
+from utils import setup_logger, get_async_openai_client, get_rate_limiters, async_call_llm_with_retry, iter_json_array, validate_json_list, BufferedLogger, ResultStore
 import config
 
 # ================= Configuration =================
 MODEL_NAME = config.GENERATION_MODEL
 CAPTION_DIR = config.CAPTION_DIR
 OUTPUT_DIR = "results/step1_qa_generation"
+RESULT_STORE_FILE = os.path.join(OUTPUT_DIR, "step1_qa.parquet")  # All videos' QAs in one file
+LEGACY_SUFFIX = "_multihop_qa.json"  # Per-video output files of earlier runs, imported into the store
 START_INDEX = 0
 END_INDEX = 467
 MAX_WORKERS = config.MAX_WORKERS_DEFAULT
 # =============================================
 
 logger = setup_logger("Step1_Generation", OUTPUT_DIR)
-client = get_openai_client()
+client = get_async_openai_client()
+store = ResultStore(RESULT_STORE_FILE, legacy_suffix=LEGACY_SUFFIX)
 
 def load_captions_text(file_path):
-    data = load_json(file_path)
-    if not data: return ""
-    
-    context_str = ""
-    for clip in data:
+    context_parts = []
+    for clip in iter_json_array(file_path):
         slice_id = clip.get('slice_num') or clip.get('slice_id')
         caption = clip.get('cap') or clip.get('caption')
         if slice_id is not None:
-            context_str += f"[Slice_{slice_id}]: {caption}\n\n"
-    return context_str
+            context_parts.append(f"[Slice_{slice_id}]: {caption}\n\n")
+    return "".join(context_parts)
 
-def get_system_prompt():
-    return """
+# Built once and sent byte-identical for every video, so provider-side prompt caching
+# can reuse it as the shared request prefix.
+SYSTEM_PROMPT = """
 # Role
 You are an expert architect of Video Understanding Benchmarks. Your goal is to create a high-quality "Multi-Hop Video QA Dataset" for **Long-Context Video Understanding**.
 
@@ -93,49 +96,63 @@ Return **ONLY** a raw JSON list.
 ]
 """
 
+JSON_DECODER = json.JSONDecoder()
+QUESTION_KEY_RE = re.compile(r'"question"\s*:')
+
 def extract_valid_json_objects(text):
-    """Robust parser for potentially truncated JSON streams."""
+    """
+    Robust parser for potentially truncated JSON streams.
+    Object boundaries come from the C JSON decoder, which is string-aware, so braces
+    inside string values never open or close a span.
+    """
     if not text: return []
     clean_text = text.replace("```json", "").replace("```", "").strip()
     
-    objects = []
-    stack = 0
-    start_idx = -1
-    
+    # Fast path: the whole response is a valid JSON list
     try:
-        for i, char in enumerate(clean_text):
-            if char == '{':
-                if stack == 0: start_idx = i
-                stack += 1
-            elif char == '}':
-                stack -= 1
-                if stack == 0 and start_idx != -1:
-                    json_str = clean_text[start_idx : i+1]
-                    try:
-                        obj = json.loads(json_str)
-                        if "question" in obj: objects.append(obj)
-                    except json.JSONDecodeError: pass
-                    start_idx = -1
-        return objects
-    except Exception as e:
-        logger.error(f"Parsing error: {e}")
-        return []
-
-def process_single_video(input_file):
+        data = orjson.loads(clean_text)
+        if isinstance(data, list):
+            return [obj for obj in data if isinstance(obj, dict) and "question" in obj]
+    except orjson.JSONDecodeError:
+        pass
+    
+    # Recovery path: only spans holding a "question" key are decoded. Each match is
+    # anchored to the nearest preceding '{' after the last decoded object.
+    objects = []
+    pos = 0
+    for match in QUESTION_KEY_RE.finditer(clean_text):
+        if match.start() < pos: continue
+        start = clean_text.rfind('{', pos, match.start())
+        while start != -1:
+            try:
+                obj, end = JSON_DECODER.raw_decode(clean_text, start)
+                if end > match.start() and isinstance(obj, dict) and "question" in obj:
+                    objects.append(obj)
+                    pos = end
+                    break
+            except json.JSONDecodeError:
+                pass
+            start = clean_text.rfind('{', pos, start)
+    return objects
+
+def write_text(text, file_path, mode="w"):
+    with open(file_path, mode, encoding='utf-8') as f:
+        f.write(text)
+
+async def process_single_video(input_file, limiters):
     video_id = os.path.splitext(os.path.basename(input_file))[0]
-    output_file = os.path.join(OUTPUT_DIR, f"{video_id}_multihop_qa.json")
     
     # Use BufferedLogger to prevent interleaved logs
     local_logger = BufferedLogger(logger, prefix=f"[{video_id}] ")
     
     local_logger.info(f"🎬 Processing Video: {video_id}")
     
-    if os.path.exists(output_file):
-        local_logger.info(f"⏩ File exists, skipping.")
+    if store.has(video_id):
+        local_logger.info(f"⏩ Already in result store, skipping.")
         local_logger.flush()
         return
 
-    context_text = load_captions_text(input_file)
+    context_text = await asyncio.to_thread(load_captions_text, input_file)
     if not context_text: 
         local_logger.flush()
         return
@@ -151,11 +168,11 @@ Please generate **at least 20 multi-hop questions** based on the context above.
 """
     
     local_logger.info(f"🤖 Generating questions with {MODEL_NAME}...")
-    raw_response = call_llm_with_retry(
+    raw_response = await async_call_llm_with_retry(
         client, MODEL_NAME, 
-        [{"role": "system", "content": get_system_prompt()}, {"role": "user", "content": user_prompt}],
+        [{"role": "system", "content": SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}],
         temperature=0.7, max_tokens=8192, logger=local_logger,
-        validator=validate_json_list
+        validator=validate_json_list, limiters=limiters
     )
 
     if raw_response:
@@ -166,26 +183,35 @@ Please generate **at least 20 multi-hop questions** based on the context above.
                 h = q.get('hop_level', 'Other')
                 counts[h] = counts.get(h, 0) + 1
             
-            save_json(parsed_json, output_file)
+            # Journaled right away: sampled generations are not cached, so a crash must not lose them
+            await asyncio.to_thread(store.append, video_id, parsed_json)
             local_logger.info(f"✅ Success! Extracted {len(parsed_json)} questions. Dist: {counts}")
         else:
             local_logger.error("❌ Parsed list is empty.")
-            with open(os.path.join(OUTPUT_DIR, f"{video_id}_error_raw.txt"), "w", encoding='utf-8') as f:
-                f.write(raw_response)
+            await asyncio.to_thread(write_text, raw_response, os.path.join(OUTPUT_DIR, f"{video_id}_error_raw.txt"))
     else:
         local_logger.error(f"❌ Failed to generate valid JSON for {video_id} after retries.")
-        with open(os.path.join(OUTPUT_DIR, "failed_videos.log"), "a", encoding='utf-8') as f:
-            f.write(f"{video_id}\n")
+        await asyncio.to_thread(write_text, f"{video_id}\n", os.path.join(OUTPUT_DIR, "failed_videos.log"), "a")
             
     local_logger.flush()
 
-if __name__ == "__main__":
+async def main():
     if not os.path.exists(CAPTION_DIR):
         logger.error(f"Directory not found: {CAPTION_DIR}")
-    else:
-        all_files = sorted(glob.glob(os.path.join(CAPTION_DIR, "*.json")))
-        target_files = all_files[START_INDEX:END_INDEX]
-        logger.info(f"🎯 Processing indices {START_INDEX}-{END_INDEX} (Total {len(target_files)}) with {MAX_WORKERS} threads")
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            executor.map(process_single_video, target_files)
+        return
+
+    all_files = sorted(glob.glob(os.path.join(CAPTION_DIR, "*.json")))
+    target_files = all_files[START_INDEX:END_INDEX]
+    logger.info(f"🎯 Processing indices {START_INDEX}-{END_INDEX} (Total {len(target_files)}) with {MAX_WORKERS} concurrent requests")
+    
+    limiters = get_rate_limiters(MAX_WORKERS)
+    results = await asyncio.gather(*(process_single_video(f, limiters) for f in target_files), return_exceptions=True)
+    for f, res in zip(target_files, results):
+        if isinstance(res, Exception):
+            logger.error(f"❌ Unhandled error for {os.path.basename(f)}: {res}")
+    
+    if store.flush():
+        logger.info(f"💾 Saved {len(store.video_ids())} videos to {RESULT_STORE_FILE}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
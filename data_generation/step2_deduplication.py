@@ -1,60 +1,71 @@
 import os
-import glob
-from utils import setup_logger, save_json, load_json
+import concurrent.futures
+from utils import setup_logger, save_json, BufferedLogger, ResultStore
 
 # ================= Configuration =================
 INPUT_DIR = "results/step1_qa_generation"   # Input from Step 1
+INPUT_STORE_FILE = os.path.join(INPUT_DIR, "step1_qa.parquet")
+LEGACY_SUFFIX = "_multihop_qa.json"  # Step 1 outputs of the old per-video layout
 OUTPUT_DIR = "results/step2_deduplication"  # Output for Step 2
+MAX_WORKERS = os.cpu_count() or 1  # CPU-bound: one process per core
+CHUNK_SIZE = 8  # Videos handed to a worker per task, amortizing pickling overhead
 # ===========================================
 
 logger = setup_logger("Step2_Deduplication", OUTPUT_DIR)
 
-def process_single_file(input_file):
-    basename = os.path.basename(input_file)
-    video_id = basename.replace("_multihop_qa.json", "")
-    
-    output_file = os.path.join(OUTPUT_DIR, f"{video_id}_deduplicated.json")
-    failed_file = os.path.join(OUTPUT_DIR, f"{video_id}_failed_deduplication.json")
-    
-    logger.info(f"\n{'='*20}\n🧹 Step 2 (Deduplication): {video_id}\n{'='*20}")
-
-    if os.path.exists(output_file):
-        logger.info(f"⏩ File exists, skipping.")
-        return
-
-    candidates = load_json(input_file)
-    if not candidates: return
-
+def dedup_filter(candidates, local_logger):
+    """Splits QAs into (valid, failed) by rejecting those with duplicate evidence slice IDs."""
     final_valid_qas = []
     failed_qas = []
     
-    logger.info(f"🚀 Checking {len(candidates)} questions...")
-
     for idx, qa in enumerate(candidates):
-        evidence_slices = qa.get('evidence_slices', [])
+        evidence_slices = tuple(qa.get('evidence_slices', []))
         
         # Check for duplicate slice IDs
         if len(evidence_slices) != len(set(evidence_slices)):
-            reason = f"Duplicate slice IDs found: {evidence_slices}"
-            logger.info(f"Q{idx+1}: ❌ Rejected ({reason})")
+            reason = f"Duplicate slice IDs found: {list(evidence_slices)}"
+            local_logger.info(f"Q{idx+1}: ❌ Rejected ({reason})")
             qa['failure_reason'] = reason
             failed_qas.append(qa)
         else:
             final_valid_qas.append(qa)
+    return final_valid_qas, failed_qas
+
+def process_single_video(item):
+    video_id, candidates = item
+    
+    output_file = os.path.join(OUTPUT_DIR, f"{video_id}_deduplicated.json")
+    failed_file = os.path.join(OUTPUT_DIR, f"{video_id}_failed_deduplication.json")
+    
+    local_logger = BufferedLogger(logger, prefix=f"[{video_id}] ")
+    local_logger.info(f"🧹 Step 2 (Deduplication): {video_id}")
+
+    if os.path.exists(output_file):
+        local_logger.info(f"⏩ File exists, skipping.")
+        local_logger.flush()
+        return
+
+    if not candidates:
+        local_logger.flush()
+        return
+
+    local_logger.info(f"🚀 Checking {len(candidates)} questions...")
+    final_valid_qas, failed_qas = dedup_filter(candidates, local_logger)
 
     save_json(final_valid_qas, output_file)
 
     if failed_qas:
         save_json(failed_qas, failed_file)
-        logger.info(f"📉 Saved {len(failed_qas)} invalid questions to: {failed_file}")
+        local_logger.info(f"📉 Saved {len(failed_qas)} invalid questions to: {failed_file}")
 
-    logger.info(f"🎉 Done. Retention rate: {len(final_valid_qas)}/{len(candidates)}")
+    local_logger.info(f"🎉 Done. Retention rate: {len(final_valid_qas)}/{len(candidates)}")
+    local_logger.flush()
 
 if __name__ == "__main__":
-    search_pattern = os.path.join(INPUT_DIR, "*_multihop_qa.json")
-    target_files = sorted(glob.glob(search_pattern))
+    store = ResultStore(INPUT_STORE_FILE, legacy_suffix=LEGACY_SUFFIX)
+    targets = list(store.scan())
     
-    logger.info(f"🎯 Step 2 processing {len(target_files)} files")
+    logger.info(f"🎯 Step 2 processing {len(targets)} videos with {MAX_WORKERS} processes")
     
-    for f in target_files:
-        process_single_file(f)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        list(executor.map(process_single_video, targets, chunksize=CHUNK_SIZE))
@@ -2,10 +2,16 @@ import os
 import glob
 import json
 import time
-import concurrent.futures
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from utils import setup_logger, get_openai_client, call_llm_with_retry, save_json, load_json
+import re
+import asyncio
+import itertools
+import statistics
+import orjson
+from contextlib import AsyncExitStack
+from openai import APITimeoutError
+from utils import setup_logger, get_async_openai_client, get_rate_limiters, acquire_limiters, estimate_tokens, save_json, load_json, iter_jsonl
 import config
+import llm_cache
 
 # ================= Configuration =================
 INPUT_DIR = "results/step2_deduplication"
@@ -13,22 +19,112 @@ OUTPUT_DIR = "results/step3_leakage_check" # Directory for intermediate files an
 FINAL_CLEAN_DIR = "results/step3_clean"   # Where clean files go
 
 # Intermediate files
-FULL_CONTEXT_FILE = os.path.join(OUTPUT_DIR, 'all_qs_full_context.json')
-LLM_INPUT_FILE = os.path.join(OUTPUT_DIR, 'qas_for_review.json')
+FULL_CONTEXT_FILE = os.path.join(OUTPUT_DIR, 'all_qs_full_context.jsonl')
 BAD_IDS_FILE = os.path.join(OUTPUT_DIR, 'bad_qa_ids.json')
+PROGRESS_FILE = os.path.join(OUTPUT_DIR, 'bad_qa_ids.partial.json')  # Incremental check state for crash recovery
 WRONG_QA_FILE = os.path.join(OUTPUT_DIR, 'wrong_question.json')
 
 MODEL_NAME = config.LEAKAGE_CHECK_MODEL
 
-BATCH_SIZE = 10
+BATCH_SIZE = 10  # Initial batch size; tuned online by BatchSizer
+MIN_BATCH_SIZE = 4
+MAX_BATCH_SIZE = 24
+BATCH_SIZE_STEP = 2
+TUNE_WINDOW = 10  # Batches observed before each batch size adjustment
+MAX_BATCH_RETRIES = 2  # Resubmissions for batches whose API call failed
 MAX_WORKERS = config.MAX_WORKERS_DEFAULT
+QUEUE_SIZE = 256  # QAs buffered between extraction and the checkers, which cut them into batches
+PROGRESS_EVERY = 10  # Persist progress after this many finished batches
+
+# Local leakage screen: QAs whose whole answer appears verbatim in the question and covers most
+# of its content words (a restated question) are marked bad without an LLM call. Short answers,
+# either/or questions and answers that only name an entity the question mentions go to the LLM.
+LEAK_MIN_ANSWER_TOKENS = 3
+LEAK_QUESTION_COVERAGE = 0.8
 # =============================================
 
 logger = setup_logger("Step3_LeakageCheck", OUTPUT_DIR)
-client = get_openai_client()
+client = get_async_openai_client()
+
+# Constant instruction prefix, kept byte-stable so provider-side prompt caching hits on every batch
+PROMPT_INTRO = (
+    "You are a strict data auditor.\n"
+    "Your task is to identify QAs where the Answer is leaked by the Question. "
+    "Check if the Answer can be fully inferred or is explicitly stated within the Question text itself, making the QA pair invalid (tautological or leaking).\n"
+    "Do NOT consider any external context. Judge strictly based on whether the Question text logically gives away the Answer.\n\n"
+    "Here is a batch of QAs. Return a JSON object with a single key 'bad_ids' containing a list of integer IDs for the bad QAs."
+)
+
+TOKEN_RE = re.compile(r'\w+')
+# "X or Y" questions name every option, so the answer repeating one of them is no leak
+CHOICE_RE = re.compile(r'\bor\b', re.IGNORECASE)
+# Function and question words, ignored when measuring how much of the question the answer covers
+STOPWORDS = frozenset(
+    "a an the and of to in on at by for with from into onto over under up down out off is are was were be "
+    "been being do does did what which who whom whose when where why how that this these those it its "
+    "he she they them his her their before after during while then than as".split()
+)
+
+def is_obvious_leak(question, answer):
+    """Cheap local check: does the question contain the whole answer word for word, and little else?"""
+    a_tokens = TOKEN_RE.findall(answer.lower())
+    if len(a_tokens) < LEAK_MIN_ANSWER_TOKENS or CHOICE_RE.search(question):
+        return False
+    q_tokens = TOKEN_RE.findall(question.lower())
+    if " " + " ".join(a_tokens) + " " not in " " + " ".join(q_tokens) + " ":
+        return False
+    # An answer naming a temporal anchor ("After the dog knocks over the red vase, ...") is contained
+    # too; only an answer covering most of the question's content restates it
+    q_content = set(q_tokens) - STOPWORDS
+    return not q_content or len(q_content & set(a_tokens)) / len(q_content) >= LEAK_QUESTION_COVERAGE
+
+class BatchSizer:
+    """
+    Online batch size controller (hill climbing on median latency per QA).
+    Every TUNE_WINDOW batches sent at the current size, the size moves by BATCH_SIZE_STEP,
+    reversing direction when per-QA latency got worse; batches of any other size (cut before the
+    last change, or a final partial batch) are not sampled. A failed batch (parse failure or
+    request timeout) caps the size at half of its own; slow but successful batches only feed the
+    median, since long reasoning calls are routine.
+    """
+    def __init__(self, initial=BATCH_SIZE):
+        self.current = initial
+        self.direction = 1
+        self.samples = []
+        self.prev_latency = None
+
+    def record(self, size, elapsed, ok):
+        if not ok:
+            if size // 2 < self.current:
+                self._resize(size // 2)
+                self.samples = []
+                self.prev_latency = None
+                self.direction = 1
+            return
+
+        if size != self.current: return
+        self.samples.append(elapsed / size)
+        if len(self.samples) < TUNE_WINDOW:
+            return
+        latency = statistics.median(self.samples)
+        if self.prev_latency is not None and latency > self.prev_latency:
+            self.direction = -self.direction
+        self.prev_latency = latency
+        self.samples = []
+        self._resize(self.current + self.direction * BATCH_SIZE_STEP)
+
+    def _resize(self, size):
+        size = max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, size))
+        if size != self.current:
+            logger.info(f"Batch size {self.current} -> {size}")
+        self.current = size
 
-def extract_candidates():
-    """Step 3.1: Extract all QAs from input files for review."""
+async def extract_candidates(qa_queue=None, checked_ids=frozenset(), local_bad_ids=None):
+    """
+    Step 3.1: Extract all QAs from input files for review.
+    If `qa_queue` is given, unchecked QAs are pushed to it one by one as soon as they are read;
+    obvious leaks are added to `local_bad_ids` instead of being sent to the LLM.
+    """
     logger.info("Starting extraction of QAs for leakage check...")
     
     if not os.path.exists(INPUT_DIR):
@@ -38,121 +134,205 @@ def extract_candidates():
     json_files = sorted(glob.glob(os.path.join(INPUT_DIR, '*.json')))
     logger.info(f"Found {len(json_files)} files to process.")
 
-    all_qas_full = []
-    llm_qas = []
     global_id = 1
     
-    for fpath in json_files:
-        filename = os.path.basename(fpath)
-        try:
-            data = load_json(fpath)
-            if not isinstance(data, list):
-                continue
+    # Records are streamed to JSONL as they are read, so the full context is never held in memory
+    with open(FULL_CONTEXT_FILE, 'wb') as full_f:
+        for fpath in json_files:
+            filename = os.path.basename(fpath)
+            try:
+                data = await asyncio.to_thread(load_json, fpath)
+                if not isinstance(data, list):
+                    continue
 
-            for item in data:
-                question = item.get('question', '').strip()
-                answer = item.get('answer', '').strip()
-                
-                # Store full context
-                full_entry = {
-                    "id": global_id,
-                    "file_name": filename,
-                    "original_item": item 
-                }
-                all_qas_full.append(full_entry)
-                
-                # Store minimal info for LLM
-                llm_entry = {
-                    "id": global_id,
-                    "question": question,
-                    "answer": answer
-                }
-                llm_qas.append(llm_entry)
-                global_id += 1
-                
-        except Exception as e:
-            logger.error(f"Error reading {filename}: {e}")
+                for item in data:
+                    question = item.get('question', '').strip()
+                    answer = item.get('answer', '').strip()
+                    
+                    # Store full context (with the normalized question, so removal never re-strips it)
+                    full_entry = {
+                        "id": global_id,
+                        "file_name": filename,
+                        "question": question,
+                        "original_item": item 
+                    }
+                    full_f.write(orjson.dumps(full_entry) + b"\n")
+                    
+                    # Minimal info for the LLM
+                    llm_entry = {
+                        "id": global_id,
+                        "question": question,
+                        "answer": answer
+                    }
+                    
+                    if qa_queue is not None and global_id not in checked_ids:
+                        if is_obvious_leak(question, answer):
+                            local_bad_ids.add(global_id)
+                        else:
+                            await qa_queue.put(llm_entry)
+                    global_id += 1
+                    
+            except Exception as e:
+                logger.error(f"Error reading {filename}: {e}")
 
-    logger.info(f"Extracted {len(all_qas_full)} QAs.")
-    save_json(all_qas_full, FULL_CONTEXT_FILE)
-    save_json(llm_qas, LLM_INPUT_FILE)
+    logger.info(f"Extracted {global_id - 1} QAs.")
     return True
 
-def check_batch(batch_data):
-    """Process a single batch of QAs with the LLM."""
-    batch_id, batch, total_batches = batch_data
-    
-    prompt_intro = (
-        "You are a strict data auditor.\n"
-        "Your task is to identify QAs where the Answer is leaked by the Question. "
-        "Check if the Answer can be fully inferred or is explicitly stated within the Question text itself, making the QA pair invalid (tautological or leaking).\n"
-        "Do NOT consider any external context. Judge strictly based on whether the Question text logically gives away the Answer.\n\n"
-        "Here is a batch of QAs. Return a JSON object with a single key 'bad_ids' containing a list of integer IDs for the bad QAs."
-    )
-    
+async def check_batch(batch_id, batch, limiters, sizer=None):
+    """Process a single batch of QAs with the LLM. Returns None if the call or parse failed."""
     qa_text = json.dumps(batch, indent=2, ensure_ascii=False)
         
-    prompt = prompt_intro + "\n\nQAs:\n" + qa_text
+    prompt = PROMPT_INTRO + "\n\nQAs:\n" + qa_text
+    
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant that returns JSON."},
+        {"role": "user", "content": prompt}
+    ]
+    cache_key = llm_cache.make_key(MODEL_NAME, messages, temperature=0.0, response_format={"type": "json_object"})
     
     try:
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that returns JSON."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0,
-            response_format={"type": "json_object"}
-        )
-        content = response.choices[0].message.content.strip()
+        content = llm_cache.get(cache_key)
+        elapsed = None  # Only real API calls feed the batch sizer
+        if content is None:
+            async with AsyncExitStack() as stack:
+                await acquire_limiters(stack, limiters, estimate_tokens(messages))
+                start = time.monotonic()
+                response = await client.chat.completions.create(
+                    model=MODEL_NAME,
+                    messages=messages,
+                    temperature=0.0,
+                    response_format={"type": "json_object"}
+                )
+                elapsed = time.monotonic() - start
+            content = response.choices[0].message.content.strip()
         
         # Parse JSON from content
         try:
-            parsed = json.loads(content)
+            parsed = orjson.loads(content)
             bad_ids = parsed.get('bad_ids', [])
+            llm_cache.put(cache_key, content)
+            if sizer and elapsed is not None:
+                sizer.record(len(batch), elapsed, ok=True)
             if isinstance(bad_ids, list):
                 return [int(x) for x in bad_ids if str(x).isdigit() or isinstance(x, int)]
             return []
         except:
-            return []
+            logger.warning(f"Unparseable response in batch {batch_id}")
+            if sizer: sizer.record(len(batch), elapsed or 0.0, ok=False)
+            return None
             
     except Exception as e:
         logger.error(f"Error in batch {batch_id}: {e}")
-        return []
+        # Only timeouts say the batch was too big; rate limits and server errors are retried as-is
+        if sizer and isinstance(e, APITimeoutError): sizer.record(len(batch), 0.0, ok=False)
+        return None
 
-def run_leakage_check():
-    """Step 3.2: Check QAs via API."""
-    logger.info("Starting API leakage check...")
-    
+async def check_batch_with_retry(batch_id, batch, limiters, sizer=None):
+    """Runs check_batch, retrying up to MAX_BATCH_RETRIES times. Returns None if every attempt failed."""
+    result = None
+    for attempt in range(MAX_BATCH_RETRIES + 1):
+        if attempt > 0:
+            logger.info(f"Retrying batch {batch_id} (attempt {attempt}/{MAX_BATCH_RETRIES})...")
+            await asyncio.sleep(2)
+        result = await check_batch(batch_id, batch, limiters, sizer)
+        if result is not None:
+            break
+    return result
+
+async def check_worker(qa_queue, result_queue, limiters, sizer, batch_ids):
+    """
+    Consumer: cuts a batch of `sizer.current` QAs from the queue at dequeue time, so a resize applies
+    to the very next batch, and checks it (retrying failures) until it receives the None sentinel.
+    """
+    finished = False
+    while not finished:
+        batch = []
+        size = sizer.current
+        while len(batch) < size:
+            item = await qa_queue.get()
+            if item is None:
+                finished = True
+                break
+            batch.append(item)
+        if not batch:
+            break
+        batch_id = next(batch_ids)
+        result = await check_batch_with_retry(batch_id, batch, limiters, sizer)
+        await result_queue.put((batch_id, batch, result))
+
+async def collect_results(result_queue, checked_ids, bad_ids):
+    """Aggregator: merges batch results and periodically persists them to PROGRESS_FILE."""
+    done = 0
+    failed_batches = []
+    while True:
+        item = await result_queue.get()
+        if item is None:
+            break
+        batch_id, batch, result = item
+        done += 1
+        if result is None:
+            failed_batches.append(batch_id)
+        else:
+            batch_ids = {qa['id'] for qa in batch}
+            checked_ids.update(batch_ids)
+            bad_ids.update(x for x in result if x in batch_ids)
+        
+        if done % PROGRESS_EVERY == 0:
+            logger.info(f"Processed {done} batches (last finished: batch {batch_id})...")
+            progress = {"checked_ids": sorted(checked_ids), "bad_ids": sorted(bad_ids)}
+            await asyncio.to_thread(save_json, progress, PROGRESS_FILE)
+    return done, failed_batches
+
+async def run_leakage_check():
+    """Step 3.1 + 3.2: Extract QAs and check them via API, overlapping file reads with LLM batches."""
     if os.path.exists(BAD_IDS_FILE):
         logger.info(f"Found existing bad IDs file at {BAD_IDS_FILE}, skipping check.")
-        return True
+        return await extract_candidates()
 
-    qas = load_json(LLM_INPUT_FILE)
-    if not qas:
-        logger.error("No QAs found for review.")
-        return False
-        
-    total_qas = len(qas)
-    batches = [qas[i:i + BATCH_SIZE] for i in range(0, total_qas, BATCH_SIZE)]
-    total_batches = len(batches)
+    logger.info("Starting API leakage check...")
     
-    logger.info(f"Processing {total_qas} QAs in {total_batches} batches.")
+    progress = load_json(PROGRESS_FILE) or {}
+    checked_ids = set(progress.get('checked_ids', []))
+    bad_ids = set(progress.get('bad_ids', []))
+    if checked_ids:
+        logger.info(f"Resuming: {len(checked_ids)} QAs already checked ({len(bad_ids)} bad).")
     
-    all_bad_ids = []
+    qa_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    result_queue = asyncio.Queue()
+    limiters = get_rate_limiters(MAX_WORKERS)
+    sizer = BatchSizer()
+    batch_ids = itertools.count()
     
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        futures = {executor.submit(check_batch, (i, batch, total_batches)): i for i, batch in enumerate(batches)}
-        
-        for i, future in enumerate(as_completed(futures)):
-            result = future.result()
-            if result:
-                all_bad_ids.extend(result)
-            if i % 10 == 0:
-                logger.info(f"Processed {i}/{total_batches} batches...")
-                
-    save_json(list(set(all_bad_ids)), BAD_IDS_FILE)
-    logger.info(f"Check complete. Found {len(set(all_bad_ids))} bad QAs.")
+    workers = [asyncio.create_task(check_worker(qa_queue, result_queue, limiters, sizer, batch_ids)) for _ in range(MAX_WORKERS)]
+    aggregator = asyncio.create_task(collect_results(result_queue, checked_ids, bad_ids))
+    
+    local_bad_ids = set()
+    try:
+        extracted = await extract_candidates(qa_queue, checked_ids, local_bad_ids)
+    finally:
+        for _ in workers:
+            await qa_queue.put(None)
+        await asyncio.gather(*workers)
+        await result_queue.put(None)
+    done, failed_batches = await aggregator
+    checked_ids.update(local_bad_ids)
+    bad_ids.update(local_bad_ids)
+    if local_bad_ids:
+        logger.info(f"Local screen flagged {len(local_bad_ids)} QAs as leaking without an LLM call.")
+    
+    progress = {"checked_ids": sorted(checked_ids), "bad_ids": sorted(bad_ids)}
+    await asyncio.to_thread(save_json, progress, PROGRESS_FILE)
+    
+    if not extracted:
+        return False
+    if failed_batches:
+        logger.error(f"{len(failed_batches)} batches failed after {MAX_BATCH_RETRIES} retries: {sorted(failed_batches)}. "
+                     f"Progress saved to {PROGRESS_FILE}; rerun to check only the remaining QAs.")
+        return False
+    
+    save_json(sorted(bad_ids), BAD_IDS_FILE)
+    os.remove(PROGRESS_FILE)
+    logger.info(f"Check complete ({done} batches this run). Found {len(bad_ids)} bad QAs.")
     return True
 
 def remove_bad_qas():
@@ -166,27 +346,21 @@ def remove_bad_qas():
     if os.path.exists(BAD_IDS_FILE):
         bad_ids = set(load_json(BAD_IDS_FILE))
     
-    full_context = load_json(FULL_CONTEXT_FILE)
-    if not full_context:
+    if not os.path.exists(FULL_CONTEXT_FILE):
         logger.error("Full context file missing.")
         return False
         
-    id_to_item = {item['id']: item for item in full_context}
-    
-    # Identify what to remove
+    # Identify what to remove in a single streamed pass over the full context (archived in id order)
     file_removals = {}
     qas_to_archive = []
     
-    for bib in bad_ids:
-        if bib not in id_to_item: continue
-        item = id_to_item[bib]
-        filename = item.get('file_name')
+    for item in iter_jsonl(FULL_CONTEXT_FILE):
+        if item['id'] not in bad_ids: continue
         original_qa = item.get('original_item')
-        q_text = original_qa.get('question', '').strip()
-        
-        if filename not in file_removals: file_removals[filename] = set()
-        file_removals[filename].add(q_text)
+        file_removals.setdefault(item.get('file_name'), set()).add(item['question'])
         qas_to_archive.append(original_qa)
+    
+    file_removals = {fn: frozenset(qs) for fn, qs in file_removals.items()}
         
     # Archive to wrong_question.json
     if qas_to_archive:
@@ -220,9 +394,10 @@ def remove_bad_qas():
         data = load_json(fpath)
         if not data: continue
         
+        # Only files with removals need their questions normalized; the rest pass through untouched
         new_data = data
-        if filename in file_removals:
-            bad_set = file_removals[filename]
+        bad_set = file_removals.get(filename)
+        if bad_set:
             new_data = [qa for qa in data if qa.get('question', '').strip() not in bad_set]
             
         save_json(new_data, out_path)
@@ -231,18 +406,13 @@ def remove_bad_qas():
     logger.info(f"Finished cleaning. Processed {cleaned_count} files.")
     return True
 
-def main():
+async def main():
     if not os.path.exists(OUTPUT_DIR):
         os.makedirs(OUTPUT_DIR)
         
-    # 1. Extraction
-    if not extract_candidates():
-        logger.error("Extraction failed.")
-        return
-        
-    # 2. Check
-    if not run_leakage_check():
-        logger.error("Leakage check failed.")
+    # 1 + 2. Extraction pipelined with the check
+    if not await run_leakage_check():
+        logger.error("Extraction or leakage check failed.")
         return
         
     # 3. Removal
@@ -253,4 +423,4 @@ def main():
     logger.info("Step 3 complete.")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
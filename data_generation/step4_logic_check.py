@@ -1,8 +1,9 @@
 import os
 import glob
+import itertools
 import json
-import concurrent.futures
-from utils import setup_logger, get_openai_client, call_llm_with_retry, save_json, load_json, parse_json_from_response, validate_json_obj, load_captions_map, BufferedLogger
+import asyncio
+from utils import setup_logger, get_async_openai_client, get_rate_limiters, async_call_llm_with_retry, save_json, load_json, parse_json_from_response, validate_json_obj, load_captions_map, get_caption, BufferedLogger
 import config
 
 # ================= Configuration =================
@@ -12,14 +13,70 @@ INPUT_DIR = "results/step3_clean"
 OUTPUT_DIR = "results/step4_logic_check"  # Output for Step 4
 START_INDEX = 0
 END_INDEX = 467
+BATCH_SIZE = 10  # QAs verified per LLM request
 MAX_WORKERS = config.MAX_WORKERS_DEFAULT
 # =============================================
 
 logger = setup_logger("Step3_LogicCheck", OUTPUT_DIR)
-client = get_openai_client()
+client = get_async_openai_client()
 
-def run_logic_check(question, answer, evidence_ids, caption_map):
-    evidence_texts = [caption_map.get(sid, "") for sid in evidence_ids]
+# Static instruction blocks are sent as byte-identical system messages ahead of the
+# per-QA content, so provider-side prompt caching can reuse the shared prefix.
+LOGIC_CHECK_SYSTEM_PROMPT = """
+### Role
+You are a strict QA Verifier. Your job is to check if the **Context** fully supports the **Answer**.
+
+### CRITICAL INSTRUCTIONS
+1. **Handle VLM Noise:** These captions are AI-generated. The same character might be named differently in different slices (e.g., "a man in blue" vs "the driver"). **Do NOT fail** just because of naming mismatches if the visual attributes (clothes, actions) align logically.
+2. **Chain of Thought:** You must trace the logic step-by-step. Does Slice X link to Slice Y logically?
+3. **Factuality:** Does the text explicitly support the answer? Do not allow external knowledge.
+
+### Output Format (Strict JSON)
+Return ONLY a raw JSON object. No markdown.
+{
+    "reasoning": "Step 1: Slice A says... Step 2: Slice B says... Logic holds because...",
+    "verdict": "PASS" or "FAIL"
+}
+"""
+
+BATCH_LOGIC_CHECK_SYSTEM_PROMPT = """
+### Role
+You are a strict QA Verifier. For each QA below, check if its **Evidence Slices** (visual captions from a video) fully support the **Answer**.
+
+### CRITICAL INSTRUCTIONS
+1. **Handle VLM Noise:** These captions are AI-generated. The same character might be named differently in different slices (e.g., "a man in blue" vs "the driver"). **Do NOT fail** just because of naming mismatches if the visual attributes (clothes, actions) align logically.
+2. **Chain of Thought:** You must trace the logic step-by-step. Does Slice X link to Slice Y logically?
+3. **Factuality:** Does the text explicitly support the answer? Do not allow external knowledge.
+4. **Independence:** Judge each QA using ONLY its own evidence slices.
+
+### Output Format (Strict JSON)
+Return ONLY a raw JSON object with one result per QA id.
+{
+    "results": [
+        {"id": 1, "reasoning": "Step 1: Slice A says... Step 2: Slice B says... Logic holds because...", "verdict": "PASS" or "FAIL"}
+    ]
+}
+"""
+
+# Shared {video_id: caption map} (see load_captions_map), filled once by preload_captions()
+CAPTIONS = {}
+
+def preload_captions(caption_files):
+    """Fills CAPTIONS for every video that still has step4 work pending."""
+    for caption_file in caption_files:
+        video_id = os.path.splitext(os.path.basename(caption_file))[0]
+        input_file = os.path.join(INPUT_DIR, f"{video_id}_deduplicated.json")
+        output_file = os.path.join(OUTPUT_DIR, f"{video_id}_passed_logic_check.json")
+        if os.path.exists(input_file) and not os.path.exists(output_file):
+            CAPTIONS[video_id] = load_captions_map(caption_file)
+
+def has_two_distinct(ids):
+    """True if `ids` holds at least two different values; short-circuits without building a set."""
+    first = ids[0] if ids else None
+    return any(sid != first for sid in itertools.islice(ids, 1, None))
+
+async def run_logic_check(question, answer, evidence_ids, caption_map, limiters, logger=logger):
+    evidence_texts = [get_caption(caption_map, sid) for sid in evidence_ids]
     if any(not t for t in evidence_texts): 
         return False, "Some Slice IDs not found in Caption file", ""
 
@@ -36,27 +93,12 @@ def run_logic_check(question, answer, evidence_ids, caption_map):
 
 ### Proposed Answer
 {answer}
-
-### Role
-You are a strict QA Verifier. Your job is to check if the **Context** fully supports the **Answer**.
-
-### CRITICAL INSTRUCTIONS
-1. **Handle VLM Noise:** These captions are AI-generated. The same character might be named differently in different slices (e.g., "a man in blue" vs "the driver"). **Do NOT fail** just because of naming mismatches if the visual attributes (clothes, actions) align logically.
-2. **Chain of Thought:** You must trace the logic step-by-step. Does Slice X link to Slice Y logically?
-3. **Factuality:** Does the text explicitly support the answer? Do not allow external knowledge.
-
-### Output Format (Strict JSON)
-Return ONLY a raw JSON object. No markdown.
-{{
-    "reasoning": "Step 1: Slice A says... Step 2: Slice B says... Logic holds because...",
-    "verdict": "PASS" or "FAIL"
-}}
 """
-    response_text = call_llm_with_retry(
+    response_text = await async_call_llm_with_retry(
         client, MODEL_NAME, 
-        [{"role": "user", "content": prompt}], 
+        [{"role": "system", "content": LOGIC_CHECK_SYSTEM_PROMPT}, {"role": "user", "content": prompt}], 
         temperature=0.1, logger=logger,
-        validator=validate_json_obj
+        validator=validate_json_obj, limiters=limiters
     )
     
     if not response_text:
@@ -78,8 +120,104 @@ Return ONLY a raw JSON object. No markdown.
             return True, "Passed (Text Match)", "Text Match (No JSON)"
         return False, f"Parse Error or Fail: {response_text}", "Parse Error"
 
-def process_single_video(caption_file):
-    video_id = os.path.splitext(os.path.basename(caption_file))[0]
+async def run_logic_check_batch(batch, caption_map, limiters, logger=logger):
+    """
+    Verifies a batch of QAs in a single LLM request.
+    `batch` is a list of (id, qa) tuples. Returns {id: (is_valid, msg, reasoning)}
+    for every id the model answered; ids missing from the response are omitted.
+    """
+    entries = []
+    for qa_id, qa in batch:
+        evidence = [{"slice_id": sid, "text": get_caption(caption_map, sid)} for sid in qa.get('evidence_slices', [])]
+        entries.append({
+            "id": qa_id,
+            "question": qa['question'],
+            "answer": qa['answer'],
+            "evidence_slices": evidence
+        })
+
+    user_prompt = "### QAs\n" + json.dumps(entries, indent=2, ensure_ascii=False)
+
+    response_text = await async_call_llm_with_retry(
+        client, MODEL_NAME,
+        [{"role": "system", "content": BATCH_LOGIC_CHECK_SYSTEM_PROMPT}, {"role": "user", "content": user_prompt}],
+        temperature=0.1, max_tokens=8192, logger=logger,
+        validator=validate_json_obj,
+        response_format={"type": "json_object"}, limiters=limiters
+    )
+
+    result_json = parse_json_from_response(response_text)
+    if not isinstance(result_json, dict) or not isinstance(result_json.get("results"), list):
+        return {}
+
+    batch_ids = {qa_id for qa_id, _ in batch}
+    results = {}
+    for item in result_json["results"]:
+        if not isinstance(item, dict) or "id" not in item: continue
+        try:
+            qa_id = int(item["id"])
+        except (TypeError, ValueError):
+            continue
+        if qa_id not in batch_ids: continue
+        verdict = str(item.get("verdict", "FAIL")).upper()
+        reason = item.get("reasoning", "No reasoning provided")
+        if verdict == "PASS":
+            results[qa_id] = (True, "Passed", reason)
+        else:
+            results[qa_id] = (False, f"LLM Rejected: {reason}", reason)
+    return results
+
+async def verify_qas(raw_qas, local_caption_map, limiters, local_logger):
+    """Runs the logic check over one video's QAs and returns (passed_qas, failed_qas)."""
+    # Pre-filter QAs that cannot pass, and queue the rest for batched verification
+    pending = []
+    results = {}
+    for idx, qa in enumerate(raw_qas):
+        # Ensure cleanup of old fields
+        qa.pop('test_a_reasoning', None)
+        
+        evidence_ids = qa.get('evidence_slices', [])
+        if not has_two_distinct(evidence_ids):
+            results[idx] = (False, "Not enough evidence slices (<2)", "")
+        elif any(not get_caption(local_caption_map, sid) for sid in evidence_ids):
+            results[idx] = (False, "Some Slice IDs not found in Caption file", "")
+        else:
+            pending.append((idx, qa))
+
+    async def check_batch(batch):
+        batch_results = await run_logic_check_batch(batch, local_caption_map, limiters, logger=local_logger)
+        
+        # Fall back to per-item calls for anything the batch response did not cover
+        missing = [(idx, qa) for idx, qa in batch if idx not in batch_results]
+        if missing:
+            local_logger.warning(f"⚠️ Batch response incomplete, re-checking {len(missing)} QAs individually.")
+            fallback = await asyncio.gather(*(
+                run_logic_check(qa['question'], qa['answer'], qa['evidence_slices'], local_caption_map, limiters, logger=local_logger)
+                for _, qa in missing
+            ))
+            batch_results.update(zip((idx for idx, _ in missing), fallback))
+        return batch_results
+
+    batches = [pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)]
+    for batch_results in await asyncio.gather(*(check_batch(b) for b in batches)):
+        results.update(batch_results)
+
+    passed_qas = []
+    failed_qas = []
+    for idx, qa in enumerate(raw_qas):
+        is_valid, msg, reasoning = results[idx]
+        
+        if is_valid:
+            local_logger.info(f"Q{idx+1}: ✅ Passed")
+            qa['logic_check_reasoning'] = reasoning
+            passed_qas.append(qa)
+        else:
+            local_logger.info(f"Q{idx+1}: ❌ Failed ({msg[:50]}...)") 
+            qa['failure_reason'] = msg
+            failed_qas.append(qa)
+    return passed_qas, failed_qas
+
+async def process_single_video(video_id, limiters):
     
     input_file = os.path.join(INPUT_DIR, f"{video_id}_deduplicated.json")
     output_file = os.path.join(OUTPUT_DIR, f"{video_id}_passed_logic_check.json")
@@ -98,56 +236,43 @@ def process_single_video(caption_file):
         local_logger.flush()
         return
 
-    local_caption_map = load_captions_map(caption_file)
+    local_caption_map = CAPTIONS.get(video_id)
     if not local_caption_map: 
         local_logger.flush()
         return
 
-    raw_qas = load_json(input_file)
+    raw_qas = await asyncio.to_thread(load_json, input_file)
     if not raw_qas: 
         local_logger.flush()
         return
 
-    passed_qas = []
-    failed_qas = []
-    
     local_logger.info(f"🚀 Verifying {len(raw_qas)} questions...")
+    passed_qas, failed_qas = await verify_qas(raw_qas, local_caption_map, limiters, local_logger)
 
-    for idx, qa in enumerate(raw_qas):
-        # Ensure cleanup of old fields
-        qa.pop('test_a_reasoning', None)
-        
-        evidence_ids = qa.get('evidence_slices', [])
-        if len(set(evidence_ids)) < 2:
-            qa['failure_reason'] = "Not enough evidence slices (<2)"
-            failed_qas.append(qa)
-            continue
-            
-        is_valid, msg, reasoning = run_logic_check(qa['question'], qa['answer'], evidence_ids, local_caption_map)
-        
-        if is_valid:
-            local_logger.info(f"Q{idx+1}: ✅ Passed")
-            qa['logic_check_reasoning'] = reasoning
-            passed_qas.append(qa)
-        else:
-            local_logger.info(f"Q{idx+1}: ❌ Failed ({msg[:50]}...)") 
-            qa['failure_reason'] = msg
-            failed_qas.append(qa)
-
-    save_json(passed_qas, output_file)
+    await asyncio.to_thread(save_json, passed_qas, output_file)
 
     if failed_qas:
-        save_json(failed_qas, failed_file)
+        await asyncio.to_thread(save_json, failed_qas, failed_file)
         local_logger.info(f"📉 Saved {len(failed_qas)} failed questions to: {failed_file}")
 
     local_logger.info(f"🎉 Done. Retention rate: {len(passed_qas)}/{len(raw_qas)}")
     local_logger.flush()
 
-if __name__ == "__main__":
+async def main():
     all_files = sorted(glob.glob(os.path.join(CAPTION_DIR, "*.json")))
     target_files = all_files[START_INDEX:END_INDEX]
     
-    logger.info(f"🎯 Step 3 processing indices {START_INDEX}-{END_INDEX} (Total {len(target_files)}) with {MAX_WORKERS} threads")
+    logger.info(f"🎯 Step 3 processing indices {START_INDEX}-{END_INDEX} (Total {len(target_files)}) with {MAX_WORKERS} concurrent requests")
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        executor.map(process_single_video, target_files)
+    await asyncio.to_thread(preload_captions, target_files)
+    logger.info(f"📚 Preloaded caption maps for {len(CAPTIONS)} videos")
+    
+    video_ids = [os.path.splitext(os.path.basename(f))[0] for f in target_files]
+    limiters = get_rate_limiters(MAX_WORKERS)
+    results = await asyncio.gather(*(process_single_video(vid, limiters) for vid in video_ids), return_exceptions=True)
+    for vid, res in zip(video_ids, results):
+        if isinstance(res, Exception):
+            logger.error(f"❌ Unhandled error for {vid}: {res}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
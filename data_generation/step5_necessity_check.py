@@ -1,10 +1,13 @@
 import os
+import re
 import glob
+import math
 import itertools
-import time
-import concurrent.futures
-from utils import setup_logger, get_openai_client, call_llm_with_retry, save_json, load_json, parse_json_from_response, validate_json_obj, load_captions_map, BufferedLogger
+import asyncio
+from collections import Counter
+from utils import setup_logger, get_async_openai_client, get_rate_limiters, async_call_llm_with_retry, run_batch_job, save_json, load_json, parse_json_from_response, validate_json_obj, load_captions_map, get_caption, iter_captions, BufferedLogger
 import config
+import llm_cache
 
 # ================= Configuration =================
 MODEL_NAME = config.NECESSITY_CHECK_MODEL
@@ -14,47 +17,24 @@ OUTPUT_DIR = "results/step5_necessity_check" # Output for Step 5
 START_INDEX = 0
 END_INDEX = 467
 MAX_WORKERS = config.MAX_WORKERS_DEFAULT
+TEMPERATURE = 0.1
+MAX_TOKENS = 4096
+# Pre-pass all subset prompts through the half-price Batch API (may take up to 24h); the answers
+# land in the LLM cache, and the regular run then resolves from it, calling live only for gaps.
+USE_BATCH_API = os.getenv("STEP5_USE_BATCH_API", "0") == "1"
 # =============================================
 
 logger = setup_logger("Step4_NecessityCheck", OUTPUT_DIR)
-client = get_openai_client()
-
-def run_necessity_check(question, evidence_ids, caption_map):
-    """
-    Test B (Necessity Check): 
-    Ensure that removing any single piece of evidence makes the question unanswerable.
-    If a subset (N-1) is sufficient to answer, then the removed piece was not necessary.
-    """
-    evidence_texts = [caption_map.get(sid, "") for sid in evidence_ids]
-    total_evidence_count = len(evidence_texts)
-    
-    # Generate all N-1 combinations
-    subsets_indices = list(itertools.combinations(range(total_evidence_count), total_evidence_count - 1))
-    
-    if not subsets_indices:
-        return False, "Evidence count < 2", ""
-
-    for subset_idx in subsets_indices:
-        # Build "Incomplete" Context
-        current_subset_texts = [evidence_texts[i] for i in subset_idx]
-        current_subset_ids = [evidence_ids[i] for i in subset_idx]
-        
-        subset_context = ""
-        for i, text in enumerate(current_subset_texts):
-            subset_context += f"[Fragment {evidence_ids[subset_idx[i]]}]: {text}\n"
-
-        prompt = f"""
-### Incomplete Context (I have DELETED one crucial evidence slice)
-{subset_context}
-
-### Question
-{question}
+client = get_async_openai_client()
 
+# The task and rules are a byte-identical system message; only the fragments and
+# question vary per call, so provider-side prompt caching reuses the shared prefix.
+NECESSITY_CHECK_SYSTEM_PROMPT = """
 ### Task: The "Missing Link" Test
-The original question required {total_evidence_count} pieces of evidence. I have **removed one**.
+You will be given an **Incomplete Context**, a **Question**, and how many pieces of evidence the original question required.
 Act as a **Literal Robot** with NO common sense.
 
-**Can you strictly deduce the full answer using ONLY the text above?**
+**Can you strictly deduce the full answer using ONLY the Incomplete Context?**
 
 ### CRITICAL INSTRUCTIONS (Handling Naming Inconsistency)
 1.  **Awareness:** Be aware that entities in this dataset may be described with **inconsistent names or attributes** across different fragments.
@@ -65,38 +45,187 @@ Act as a **Literal Robot** with NO common sense.
 
 ### Output Format (Strict JSON)
 Return ONLY a raw JSON object.
-{{
+{
     "missing_analysis": "Abstractly analyze what logical link or identity definition is missing...",
     "verdict": "SOLVABLE" (if fully answerable) or "INSUFFICIENT" (if info is missing)
-}}
+}
+"""
+
+# Per-subset user message, worded as in the original single-message prompt
+NECESSITY_PROMPT_TMPL = """
+### Incomplete Context (I have DELETED one crucial evidence slice)
+{subset_context}
+
+### Question
+{question}
+
+The original question required {total} pieces of evidence. I have **removed one**.
 """
-        response_text = call_llm_with_retry(
-            client, MODEL_NAME, 
-            [{"role": "user", "content": prompt}], 
-            temperature=0.1, logger=logger,
-            validator=validate_json_obj
+
+def build_subset_requests(question, evidence_ids, caption_map):
+    """Returns [(subset_idx, messages)] with one request per distinct N-1 subset of the evidence."""
+    # Each fragment is formatted once and shared by the N-1 subsets that include it
+    fragments = [f"[Fragment {sid}]: {get_caption(caption_map, sid)}" for sid in evidence_ids]
+    total_evidence_count = len(fragments)
+    
+    # Generate all N-1 combinations; subsets with the same fragments (duplicate slice ids,
+    # in any order) get the same verdict, so each is asked once
+    unique_subsets = {}
+    for subset_idx in itertools.combinations(range(total_evidence_count), total_evidence_count - 1):
+        key = tuple(sorted(fragments[i] for i in subset_idx))
+        unique_subsets.setdefault(key, subset_idx)
+
+    requests = []
+    for subset_idx in unique_subsets.values():
+        # Build "Incomplete" Context
+        subset_context = "\n".join(fragments[i] for i in subset_idx) + "\n"
+
+        prompt = NECESSITY_PROMPT_TMPL.format(total=total_evidence_count, subset_context=subset_context, question=question)
+        requests.append((subset_idx, [{"role": "system", "content": NECESSITY_CHECK_SYSTEM_PROMPT}, {"role": "user", "content": prompt}]))
+    return requests
+
+TOKEN_RE = re.compile(r'\w+')
+
+def build_idf(caption_map):
+    """Smoothed inverse document frequency of every token over one video's captions."""
+    df = Counter()
+    n = 0
+    for cap in iter_captions(caption_map):
+        df.update(set(TOKEN_RE.findall(cap.lower())))
+        n += 1
+    return {tok: math.log((1 + n) / (1 + count)) + 1 for tok, count in df.items()}
+
+def evidence_weights(evidence_ids, caption_map, idf):
+    """TF-IDF norm of each evidence caption: a rough measure of how much information it carries."""
+    weights = []
+    for sid in evidence_ids:
+        tf = Counter(TOKEN_RE.findall(get_caption(caption_map, sid).lower()))
+        weights.append(math.sqrt(sum((count * idf.get(tok, 1.0)) ** 2 for tok, count in tf.items())))
+    return weights
+
+def find_duplicate_evidence(evidence_ids, caption_map):
+    """
+    Returns the first pair of slice ids that repeat each other (same id or byte-identical caption), else None.
+    Near-identical captions are deliberately not matched: State_Mutation QAs compare such shots.
+    """
+    seen_ids, seen_caps = set(), {}
+    for sid in evidence_ids:
+        if sid in seen_ids: return sid, sid
+        cap = get_caption(caption_map, sid)
+        if cap and cap in seen_caps: return seen_caps[cap], sid
+        seen_ids.add(sid)
+        if cap: seen_caps[cap] = sid
+    return None
+
+async def run_necessity_check(question, evidence_ids, caption_map, idf, limiters, logger=logger):
+    """
+    Test B (Necessity Check): 
+    Ensure that removing any single piece of evidence makes the question unanswerable.
+    If a subset (N-1) is sufficient to answer, then the removed piece was not necessary.
+    """
+    subset_requests = build_subset_requests(question, evidence_ids, caption_map)
+    
+    if not subset_requests:
+        return False, "Evidence count < 2", ""
+
+    # A repeated slice or caption: dropping either copy leaves the other, so the test fails without the LLM
+    duplicate = find_duplicate_evidence(evidence_ids, caption_map)
+    if duplicate:
+        return False, f"Fail: Redundant evidence, slices {duplicate[0]} and {duplicate[1]} are identical", ""
+
+    # Subsets keeping the most caption mass (i.e. dropping the least informative slice) are the
+    # likeliest to be SOLVABLE, so the top-ranked one is asked first, alone
+    weights = evidence_weights(evidence_ids, caption_map, idf)
+    subset_requests.sort(key=lambda req: sum(weights[i] for i in req[0]), reverse=True)
+
+    async def check_subset(messages):
+        return await async_call_llm_with_retry(
+            client, MODEL_NAME, messages, 
+            temperature=TEMPERATURE, max_tokens=MAX_TOKENS, logger=logger,
+            validator=validate_json_obj, limiters=limiters
         )
-        
+
+    def judge(subset_idx, response_text):
+        """Returns the failing result for a decisive response (SOLVABLE or API failure), else None."""
+        current_subset_ids = [evidence_ids[i] for i in subset_idx]
         if not response_text:
             return False, "API Call Failed (Retries Exhausted)", "API Error"
 
         result_json = parse_json_from_response(response_text)
-        
+
         if result_json:
             verdict = result_json.get("verdict", "INSUFFICIENT").upper()
             analysis = result_json.get("missing_analysis", "")
-            
+
             # If ANY subset is solvable, the test fails (because not all pieces were necessary)
             if verdict == "SOLVABLE":
                 return False, f"Fail: Solvable by subset {current_subset_ids}. Reasoning: {analysis}", analysis
         else:
             # Fallback text match
             if response_text and "SOLVABLE" in response_text.upper():
-                 return False, f"Fail: Solvable (Text Match) by subset {current_subset_ids}", "Text Match"
+                return False, f"Fail: Solvable (Text Match) by subset {current_subset_ids}", "Text Match"
+        return None
+
+    first_idx, first_messages = subset_requests[0]
+    failure = judge(first_idx, await check_subset(first_messages))
+    if failure:
+        return failure
+
+    # The remaining subsets are independent, so they are checked concurrently and the
+    # first decisive result ends the test early.
+    tasks = {asyncio.ensure_future(check_subset(messages)): subset_idx for subset_idx, messages in subset_requests[1:]}
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                failure = judge(tasks[task], task.result())
+                if failure:
+                    return failure
+    finally:
+        # Cancel the subset calls still waiting or in flight
+        for task in pending:
+            task.cancel()
 
     return True, "Passed Strict N-1 Test", ""
 
-def process_single_video(caption_file):
+def collect_batch_requests(target_files):
+    """Returns {cache_key: request body} for every uncached subset prompt of the videos still pending."""
+    requests = {}
+    for caption_file in target_files:
+        video_id = os.path.splitext(os.path.basename(caption_file))[0]
+        input_file = os.path.join(INPUT_DIR, f"{video_id}_passed_logic_check.json")
+        output_file = os.path.join(OUTPUT_DIR, f"{video_id}_passed_necessity_check.json")
+        if not os.path.exists(input_file) or os.path.exists(output_file): continue
+
+        caption_map = load_captions_map(caption_file)
+        for qa in load_json(input_file) or []:
+            # QAs with repeated evidence fail locally and never reach the LLM
+            if find_duplicate_evidence(qa.get('evidence_slices', []), caption_map): continue
+            for _, messages in build_subset_requests(qa['question'], qa.get('evidence_slices', []), caption_map):
+                key = llm_cache.make_key(MODEL_NAME, messages, temperature=TEMPERATURE, max_tokens=MAX_TOKENS)
+                if key not in requests and llm_cache.get(key) is None:
+                    requests[key] = {"model": MODEL_NAME, "messages": messages, "temperature": TEMPERATURE, "max_tokens": MAX_TOKENS}
+    return requests
+
+async def prefill_cache_with_batch(target_files):
+    """Batch API pre-pass: stores validated answers under the same cache keys the live path looks up."""
+    if not config.LLM_CACHE_ENABLED:
+        logger.warning("⚠️ Batch API mode needs the LLM cache; running live requests only.")
+        return
+    requests = await asyncio.to_thread(collect_batch_requests, target_files)
+    logger.info(f"📦 {len(requests)} uncached subset prompts for the Batch API")
+    if not requests: return
+
+    results = await run_batch_job(client, list(requests.items()), os.path.join(OUTPUT_DIR, "batch"), logger=logger)
+    stored = 0
+    for key, content in results.items():
+        if validate_json_obj(content):
+            llm_cache.put(key, content)
+            stored += 1
+    logger.info(f"📦 Batch API answered {stored}/{len(requests)} prompts; the rest run live.")
+
+async def process_single_video(caption_file, limiters):
     video_id = os.path.splitext(os.path.basename(caption_file))[0]
     
     input_file = os.path.join(INPUT_DIR, f"{video_id}_passed_logic_check.json")
@@ -116,12 +245,12 @@ def process_single_video(caption_file):
         local_logger.flush()
         return
 
-    local_caption_map = load_captions_map(caption_file)
+    local_caption_map = await asyncio.to_thread(load_captions_map, caption_file)
     if not local_caption_map: 
         local_logger.flush()
         return
 
-    raw_qas = load_json(input_file)
+    raw_qas = await asyncio.to_thread(load_json, input_file)
     if not raw_qas: 
         local_logger.flush()
         return
@@ -131,10 +260,13 @@ def process_single_video(caption_file):
     
     local_logger.info(f"🚀 Verifying {len(raw_qas)} questions...")
 
-    for idx, qa in enumerate(raw_qas):
-        evidence_ids = qa.get('evidence_slices', [])
-        is_valid, reason, missing_analysis = run_necessity_check(qa['question'], evidence_ids, local_caption_map)
-        
+    idf = build_idf(local_caption_map)
+    results = await asyncio.gather(*(
+        run_necessity_check(qa['question'], qa.get('evidence_slices', []), local_caption_map, idf, limiters, logger=local_logger)
+        for qa in raw_qas
+    ))
+
+    for idx, (qa, (is_valid, reason, missing_analysis)) in enumerate(zip(raw_qas, results)):
         if is_valid:
             local_logger.info(f"Q{idx+1}: ✅ Passed")
             passed_qas.append(qa)
@@ -143,24 +275,30 @@ def process_single_video(caption_file):
             qa['failure_reason'] = reason
             qa['missing_analysis'] = missing_analysis
             failed_qas.append(qa)
-        
-        # Small delay to avoid rate limits if running very fast, though retry handles it.
-        # time.sleep(0.2) 
 
-    save_json(passed_qas, output_file)
+    await asyncio.to_thread(save_json, passed_qas, output_file)
 
     if failed_qas:
-        save_json(failed_qas, failed_file)
+        await asyncio.to_thread(save_json, failed_qas, failed_file)
         local_logger.info(f"📉 Saved {len(failed_qas)} failed questions to: {failed_file}")
 
     local_logger.info(f"🎉 Done. Retention rate: {len(passed_qas)}/{len(raw_qas)}")
     local_logger.flush()
 
-if __name__ == "__main__":
+async def main():
     all_files = sorted(glob.glob(os.path.join(CAPTION_DIR, "*.json")))
     target_files = all_files[START_INDEX:END_INDEX]
     
-    logger.info(f"🎯 Step 4 processing indices {START_INDEX}-{END_INDEX} (Total {len(target_files)}) with {MAX_WORKERS} threads")
+    logger.info(f"🎯 Step 4 processing indices {START_INDEX}-{END_INDEX} (Total {len(target_files)}) with {MAX_WORKERS} concurrent requests")
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        executor.map(process_single_video, target_files)
+    if USE_BATCH_API:
+        await prefill_cache_with_batch(target_files)
+
+    limiters = get_rate_limiters(MAX_WORKERS)
+    results = await asyncio.gather(*(process_single_video(f, limiters) for f in target_files), return_exceptions=True)
+    for caption_file, res in zip(target_files, results):
+        if isinstance(res, Exception):
+            logger.error(f"❌ Unhandled error for {caption_file}: {res}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,64 +1,219 @@
 import os
+import re
 import glob
 import json
-import time
+import functools
+import urllib.parse
 import base64
+import asyncio
+import threading
 import concurrent.futures
-from utils import setup_logger, get_openai_client, call_llm_with_retry, save_json, load_json, parse_json_from_response, validate_json_obj, BufferedLogger
+from collections import OrderedDict
+from utils import setup_logger, get_async_openai_client, get_rate_limiters, async_call_llm_with_retry, save_json, load_json, parse_json_from_response, validate_json_obj, iter_jsonl, BufferedLogger
 import config
 
 # ================= Configuration =================
 MODEL_NAME = config.VIDEO_VERIFICATION_MODEL # VLM Model
 CAPTION_DIR = config.CAPTION_DIR
 VIDEO_ROOT_DIR = config.VIDEO_ROOT_DIR
+VIDEO_URL_BASE = config.VIDEO_URL_BASE
 
 INPUT_DIR = "results/step5_necessity_check"   # Input from Step 5
 OUTPUT_DIR = "results/step6_video_verification" # Output for Step 6
 START_INDEX = 0
 END_INDEX = 467
 MAX_WORKERS = config.MAX_WORKERS_VIDEO
+ENCODE_CHUNK_SIZE = 3 * 64 * 1024  # Multiple of 3, so chunk encodings concatenate without padding
+CLIP_CACHE_MAX_BYTES = 1 << 30  # Budget for reused clip encodings shared by all workers
 # =============================================
 
 logger = setup_logger("Step5_VideoVerification", OUTPUT_DIR)
-client = get_openai_client()
+client = get_async_openai_client()
 
-def get_clip_path(video_id, slice_id):
-    """Finds the video clip file (supports fuzzy matching)."""
-    slice_str = str(slice_id).zfill(3)
+# Static auditor instructions are sent as an unchanged system message; the clip count,
+# clips, question and answer follow, so provider-side prompt caching reuses the prefix.
+VIDEO_VERIFICATION_SYSTEM_PROMPT = """
+You are an expert **Video QA Auditor**.
+You will be provided with several distinct video clips to analyze, followed by a question and its original answer.
+
+**🎥 EVIDENCE CONTEXT (CRITICAL):**
+1. **Single Source:** All clips are extracted from the **SAME continuous long video**. 
+2. **Temporal Discontinuity:** Although from the same source, these clips are **time-sliced**.
+
+**🕵️ YOUR TASK:**
+1. **Visual Verification:** Can the question be answered *purely* based on the visual information in these clips?
+2. **Fact Check:** Validate the "Original Answer".
+   - If the answer describes something visible in the clips, verify its accuracy.
+   - If the Original Answer is **visually contradicted** (e.g., wrong color, wrong person, action didn't happen), provide a `refined_answer`.
+
+**OUTPUT FORMAT (JSON):**
+{
+  "verdict_is_answerable": true/false,
+  "unanswerable_reason": "Explanation if false...",
+  "verdict_is_correct": true/false,
+  "refined_answer": "Corrected answer or Original answer.",
+  "visual_proof": "Briefly describe the specific visual details from the clips that support your verdict."
+}
+"""
+
+# Per-question text parts of the user message
+CLIP_COUNT_TMPL = "You are provided with **{clip_count} distinct video clips**, all from the SAME long video."
+CLIP_HEADER_TMPL = "\n\n=== 🎞️ CLIP {index}/{clip_count} (ID: {sid}) ==="
+VIDEO_INPUT_TMPL = """
+
+**INPUT DATA:**
+* **Question:** {question}
+* **Original Answer:** {original_answer}
+"""
+
+# Clip files are named "<video_id>-Scene-<NNN>.mp4"
+SCENE_RE = re.compile(r'-Scene-(\d+)\.mp4$')
+
+@functools.lru_cache(maxsize=512)
+def scan_video_folder(folder):
+    """Lists a clip folder once: (sorted .mp4 names, name set, {scene number string: first name})."""
+    try:
+        names = sorted(e.name for e in os.scandir(folder) if e.name.endswith(".mp4") and not e.name.startswith("."))
+    except OSError:
+        names = []
+    scenes = {}
+    for name in names:
+        m = SCENE_RE.search(name)
+        if m: scenes.setdefault(m.group(1), name)
+    return names, frozenset(names), scenes
+
+@functools.lru_cache(maxsize=512)
+def get_video_folder(video_id):
     video_folder = os.path.join(VIDEO_ROOT_DIR, video_id)
-    
     # Compatibility: If ID folder doesn't exist, try root
-    if not os.path.exists(video_folder):
-        video_folder = VIDEO_ROOT_DIR
+    return video_folder if os.path.exists(video_folder) else VIDEO_ROOT_DIR
+
+def get_clip_path(video_id, slice_id):
+    """Finds the video clip file (supports fuzzy matching), from a cached listing of the clip folder."""
+    slice_str = str(slice_id).zfill(3)
+    video_folder = get_video_folder(video_id)
+    names, name_set, scenes = scan_video_folder(video_folder)
     
     # 1. Try standard naming
     filename = f"{video_id}-Scene-{slice_str}.mp4"
-    full_path = os.path.join(video_folder, filename)
-    if os.path.exists(full_path):
-        return full_path
+    if filename in name_set:
+        return os.path.join(video_folder, filename)
     
-    # 2. Try wildcard matching
-    patterns = [
-        os.path.join(video_folder, f"*-Scene-{slice_str}.mp4"),
-        os.path.join(video_folder, f"*{slice_id}.mp4")
-    ]
-    for p in patterns:
-        matches = glob.glob(p)
-        if matches: return matches[0]
+    # 2. Try wildcard matching: *-Scene-{slice_str}.mp4, then *{slice_id}.mp4
+    if slice_str in scenes:
+        return os.path.join(video_folder, scenes[slice_str])
+    suffix = f"{slice_id}.mp4"
+    for name in names:
+        if name.endswith(suffix):
+            return os.path.join(video_folder, name)
         
     return None
 
-def encode_video_to_base64(video_path):
-    """Reads video file and converts to Base64 string."""
+def prefetch_clips(paths):
+    """Queues kernel readahead for every clip up front, so the encode reads are served from page cache."""
+    if not hasattr(os, "posix_fadvise"): return  # Not available on this platform
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError:
+            continue
+
+DATA_URL_PREFIX = b"data:video/mp4;base64,"
+
+def encode_video_to_data_url(video_path):
+    """
+    Reads a video file into a base64 data URL, streaming so the raw file is never held whole.
+    The prefix and encoding fill one presized buffer, so the only full copy is the final decode
+    (peak ~2.7x the file size: the buffer and the string, each 4/3 of it).
+    """
     if not os.path.exists(video_path): return None
     try:
-        with open(video_path, "rb") as video_file:
-            return base64.b64encode(video_file.read()).decode('utf-8')
+        size = os.path.getsize(video_path)
+        encoded = bytearray(len(DATA_URL_PREFIX) + 4 * ((size + 2) // 3))
+        encoded[:len(DATA_URL_PREFIX)] = DATA_URL_PREFIX
+        pos = len(DATA_URL_PREFIX)
+        with open(video_path, "rb", buffering=0) as video_file:
+            while chunk := video_file.read(ENCODE_CHUNK_SIZE):
+                block = base64.b64encode(chunk)
+                encoded[pos:pos + len(block)] = block
+                pos += len(block)
+        del encoded[pos:]  # Only needed if the file shrank while being read
+        return encoded.decode('ascii')
     except Exception as e:
         logger.error(f"Error encoding video {video_path}: {e}")
         return None
 
-def verify_visual_logic(qa_item, video_id, logger=logger):
+# Encoded clips keyed by (path, mtime); questions of a video share evidence clips, so each clip is read once
+_CLIP_CACHE = OrderedDict()
+_CLIP_CACHE_BYTES = 0
+_CLIP_CACHE_LOCK = threading.Lock()
+
+def get_clip_data_url(video_path):
+    """encode_video_to_data_url behind a byte-bounded LRU cache."""
+    global _CLIP_CACHE_BYTES
+    try:
+        key = (video_path, os.path.getmtime(video_path))
+    except OSError:
+        return None
+    with _CLIP_CACHE_LOCK:
+        if key in _CLIP_CACHE:
+            _CLIP_CACHE.move_to_end(key)
+            return _CLIP_CACHE[key]
+
+    encoded = encode_video_to_data_url(video_path)
+    if encoded is None: return None
+
+    with _CLIP_CACHE_LOCK:
+        if key not in _CLIP_CACHE:
+            _CLIP_CACHE[key] = encoded
+            _CLIP_CACHE_BYTES += len(encoded)
+            while _CLIP_CACHE_BYTES > CLIP_CACHE_MAX_BYTES and len(_CLIP_CACHE) > 1:
+                _, evicted = _CLIP_CACHE.popitem(last=False)
+                _CLIP_CACHE_BYTES -= len(evicted)
+    return encoded
+
+def get_clip_url(video_path):
+    """Maps a clip under VIDEO_ROOT_DIR to its address under VIDEO_URL_BASE."""
+    rel_path = os.path.relpath(video_path, VIDEO_ROOT_DIR).replace(os.sep, "/")
+    return f"{VIDEO_URL_BASE.rstrip('/')}/{urllib.parse.quote(rel_path)}"
+
+def get_clip_ref(video_path):
+    """Short stand-in for an inline clip in the LLM cache key: the file's path and mtime."""
+    try:
+        return f"{video_path}@{os.path.getmtime(video_path)}"
+    except OSError:
+        return video_path
+
+def load_clips(video_id, evidence_ids):
+    """
+    Resolves every evidence clip concurrently; returns (paths, video_url values, cache refs) in clip order.
+    URLs are their own cache refs; inline clips are referenced by path and mtime, never hashed whole.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(evidence_ids)) as executor:
+        paths = list(executor.map(lambda sid: get_clip_path(video_id, sid), evidence_ids))
+        if VIDEO_URL_BASE:
+            # The provider fetches the raw file itself: nothing to read, encode or upload inline
+            urls = [get_clip_url(p) if p else None for p in paths]
+            return paths, urls, urls
+        prefetch_clips([p for p in paths if p])
+        # Cached data URLs go into the request as-is, without another full-size copy
+        data_urls = list(executor.map(lambda p: get_clip_data_url(p) if p else None, paths))
+    refs = [get_clip_ref(p) if p else None for p in paths]
+    return paths, data_urls, refs
+
+async def verify_visual_logic(qa_item, video_id, clip_slots, limiters, logger=logger):
+    """
+    Verifies one QA against its clips. `clip_slots` bounds how many questions hold
+    encoded clips at once, since each request carries several MB of base64 video.
+    """
+    async with clip_slots:
+        return await _verify_visual_logic(qa_item, video_id, limiters, logger)
+
+async def _verify_visual_logic(qa_item, video_id, limiters, logger):
     question = qa_item['question']
     original_answer = qa_item['answer']
     evidence_ids = qa_item['evidence_slices']
@@ -66,69 +221,51 @@ def verify_visual_logic(qa_item, video_id, logger=logger):
     if not evidence_ids: return False, "No evidence slices", None
     
     messages_content = []
+    cache_content = []  # messages_content with each clip replaced by its cache ref
     clip_count = len(evidence_ids)
     
-    system_instruction = f"""
-You are an expert **Video QA Auditor**.
-You will be provided with **{clip_count} distinct video clips** to analyze.
-
-**🎥 EVIDENCE CONTEXT (CRITICAL):**
-1. **Single Source:** All {clip_count} clips are extracted from the **SAME continuous long video**. 
-2. **Temporal Discontinuity:** Although from the same source, these clips are **time-sliced**.
-
-**🕵️ YOUR TASK:**
-1. **Visual Verification:** Can the question be answered *purely* based on the visual information in these {clip_count} clips?
-2. **Fact Check:** Validate the "Original Answer".
-   - If the answer describes something visible in the clips, verify its accuracy.
-   - If the Original Answer is **visually contradicted** (e.g., wrong color, wrong person, action didn't happen), provide a `refined_answer`.
-
-**INPUT DATA:**
-* **Question:** {question}
-* **Original Answer:** {original_answer}
-
-**OUTPUT FORMAT (JSON):**
-{{
-  "verdict_is_answerable": true/false,
-  "unanswerable_reason": "Explanation if false...",
-  "verdict_is_correct": true/false,
-  "refined_answer": "Corrected answer or Original answer.",
-  "visual_proof": "Briefly describe the specific visual details from the clips that support your verdict."
-}}
-"""
-    messages_content.append({"type": "text", "text": system_instruction})
+    messages_content.append({"type": "text", "text": CLIP_COUNT_TMPL.format(clip_count=clip_count)})
+    cache_content.append(messages_content[-1])
 
     found_video = False
     
-    # --- Process each Evidence Slice ---
-    for i, sid in enumerate(evidence_ids):
-        v_path = get_clip_path(video_id, sid)
+    # --- Load every Evidence Slice concurrently (disk reads overlap; map keeps clip order) ---
+    paths, clip_urls, clip_refs = await asyncio.to_thread(load_clips, video_id, evidence_ids)
+
+    for i, (sid, v_path, clip_url, clip_ref) in enumerate(zip(evidence_ids, paths, clip_urls, clip_refs)):
         if v_path:
-            b64_video = encode_video_to_base64(v_path)
-            if b64_video:
+            if clip_url:
                 found_video = True
-                clip_header = f"\n\n=== 🎞️ CLIP {i+1}/{clip_count} (ID: {sid}) ==="
+                clip_header = CLIP_HEADER_TMPL.format(index=i + 1, clip_count=clip_count, sid=sid)
                 messages_content.append({"type": "text", "text": clip_header})
                 messages_content.append({
                     "type": "video_url",
-                    "video_url": {"url": f"data:video/mp4;base64,{b64_video}"}
+                    "video_url": {"url": clip_url}
                 })
+                cache_content += [messages_content[-2], {"type": "video_url", "video_url": {"url": clip_ref}}]
         else:
             logger.warning(f"  ⚠️ Clip {sid} not found for video {video_id}.")
 
     if not found_video:
         return False, "No video files found", None
+
+    # Per-question fields go last so everything before them stays cacheable
+    messages_content.append({"type": "text", "text": VIDEO_INPUT_TMPL.format(question=question, original_answer=original_answer)})
+    cache_content.append(messages_content[-1])
     
     logger.info(f"  📸 Sending {clip_count} video clips to VLM...")
 
     # --- API Call ---
-    response_text = call_llm_with_retry(
+    response_text = await async_call_llm_with_retry(
         client, 
         MODEL_NAME, 
-        [{"role": "user", "content": messages_content}], 
+        [{"role": "system", "content": VIDEO_VERIFICATION_SYSTEM_PROMPT}, {"role": "user", "content": messages_content}], 
         temperature=0.0, 
         max_tokens=8192, 
         logger=logger,
-        validator=validate_json_obj
+        validator=validate_json_obj,
+        limiters=limiters,
+        cache_messages=[{"role": "system", "content": VIDEO_VERIFICATION_SYSTEM_PROMPT}, {"role": "user", "content": cache_content}]
     )
     
     if response_text:
@@ -136,12 +273,58 @@ You will be provided with **{clip_count} distinct video clips** to analyze.
     else:
         return False, "API Call Failed (Retries Exhausted)", None
 
-def process_single_video(caption_file):
+def apply_verdict(qa, idx, success, msg, resp_text, local_logger):
+    """Records the VLM verdict on `qa` (refined answer, proof or failure reason); returns True if it passed."""
+    if success:
+        result_json = parse_json_from_response(resp_text)
+        
+        if result_json:
+            is_answerable = result_json.get("verdict_is_answerable", False)
+            is_correct = result_json.get("verdict_is_correct", False)
+            
+            if is_answerable:
+                if is_correct:
+                    local_logger.info(f"Q{idx+1}: ✅ Passed (Original Correct)")
+                else:
+                    local_logger.info(f"Q{idx+1}: ✅ Passed (Refined)")
+                    qa['original_text_answer'] = qa['answer']
+                    qa['answer'] = result_json.get("refined_answer", qa['answer'])
+                    qa['verdict_meta'] = "REFINED"
+
+                qa['visual_proof'] = result_json.get("visual_proof", "Verified by VLM")
+                return True
+            else:
+                reason = result_json.get("unanswerable_reason", "Unknown")
+                local_logger.info(f"Q{idx+1}: ❌ Failed (Unanswerable: {reason[:50]}...)")
+                qa['failure_reason'] = reason
+        else:
+            local_logger.warning(f"Q{idx+1}: ⚠️ JSON Parse Error")
+            qa['failure_reason'] = "JSON Parse Error"
+    else:
+        local_logger.error(f"Q{idx+1}: ⚠️ API Error: {msg}")
+        qa['failure_reason'] = f"API Error: {msg}"
+    return False
+
+def qa_key(qa):
+    """Identifies a QA across runs by its question and evidence slices."""
+    return qa['question'] + "\x00" + ",".join(map(str, qa['evidence_slices']))
+
+_PROGRESS_LOCK = threading.Lock()
+
+def append_progress(progress_file, record):
+    """Appends one verified QA to the per-video checkpoint file."""
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _PROGRESS_LOCK:
+        with open(progress_file, 'a', encoding='utf-8') as f:
+            f.write(line)
+
+async def process_single_video(caption_file, clip_slots, limiters):
     video_id = os.path.splitext(os.path.basename(caption_file))[0]
     
     input_file = os.path.join(INPUT_DIR, f"{video_id}_passed_necessity_check.json")
     output_file = os.path.join(OUTPUT_DIR, f"{video_id}_passed_video_check.json")
     failed_file = os.path.join(OUTPUT_DIR, f"{video_id}_failed_video_check.json")
+    progress_file = os.path.join(OUTPUT_DIR, f"{video_id}_progress.jsonl")
     
     local_logger = BufferedLogger(logger, prefix=f"[{video_id}] ")
     local_logger.info(f"🎥 Step 6 (Video Verification): {video_id}")
@@ -156,68 +339,56 @@ def process_single_video(caption_file):
         local_logger.flush()
         return
 
-    raw_qas = load_json(input_file)
+    raw_qas = await asyncio.to_thread(load_json, input_file)
     if not raw_qas: 
         local_logger.flush()
         return
 
-    passed_qas = []
-    failed_qas = []
+    # Verdicts from an interrupted run, so only unverified questions hit the VLM again
+    done = {record["key"]: record for record in await asyncio.to_thread(lambda: list(iter_jsonl(progress_file)))}
+    if done:
+        local_logger.info(f"🔁 Resuming: {len(done)} questions already verified.")
     
     local_logger.info(f"🚀 Verifying {len(raw_qas)} questions...")
 
-    for idx, qa in enumerate(raw_qas):
-        success, msg, resp_text = verify_visual_logic(qa, video_id, logger=local_logger)
-        
-        if success:
-            result_json = parse_json_from_response(resp_text)
-            
-            if result_json:
-                is_answerable = result_json.get("verdict_is_answerable", False)
-                is_correct = result_json.get("verdict_is_correct", False)
-                
-                if is_answerable:
-                    if is_correct:
-                        local_logger.info(f"Q{idx+1}: ✅ Passed (Original Correct)")
-                    else:
-                        local_logger.info(f"Q{idx+1}: ✅ Passed (Refined)")
-                        qa['original_text_answer'] = qa['answer']
-                        qa['answer'] = result_json.get("refined_answer", qa['answer'])
-                        qa['verdict_meta'] = "REFINED"
-
-                    qa['visual_proof'] = result_json.get("visual_proof", "Verified by VLM")
-                    passed_qas.append(qa)
-                else:
-                    reason = result_json.get("unanswerable_reason", "Unknown")
-                    local_logger.info(f"Q{idx+1}: ❌ Failed (Unanswerable: {reason[:50]}...)")
-                    qa['failure_reason'] = reason
-                    failed_qas.append(qa)
-            else:
-                local_logger.warning(f"Q{idx+1}: ⚠️ JSON Parse Error")
-                qa['failure_reason'] = "JSON Parse Error"
-                failed_qas.append(qa)
-        else:
-            local_logger.error(f"Q{idx+1}: ⚠️ API Error: {msg}")
-            qa['failure_reason'] = f"API Error: {msg}"
-            failed_qas.append(qa)
-        
-        # Avoid rate limits
-        time.sleep(1)
+    async def check_qa(idx, qa):
+        key = qa_key(qa)
+        if key in done:
+            return done[key]["passed"], done[key]["qa"]
+        success, msg, resp_text = await verify_visual_logic(qa, video_id, clip_slots, limiters, logger=local_logger)
+        passed = apply_verdict(qa, idx, success, msg, resp_text, local_logger)
+        if success:  # API failures are not checkpointed, so a rerun retries them
+            await asyncio.to_thread(append_progress, progress_file, {"key": key, "passed": passed, "qa": qa})
+        return passed, qa
 
-    save_json(passed_qas, output_file)
+    results = await asyncio.gather(*(check_qa(idx, qa) for idx, qa in enumerate(raw_qas)))
+    passed_qas = [qa for passed, qa in results if passed]
+    failed_qas = [qa for passed, qa in results if not passed]
+
+    await asyncio.to_thread(save_json, passed_qas, output_file)
 
     if failed_qas:
-        save_json(failed_qas, failed_file)
+        await asyncio.to_thread(save_json, failed_qas, failed_file)
         local_logger.info(f"📉 Saved {len(failed_qas)} failed questions to: {failed_file}")
 
+    if os.path.exists(progress_file):
+        os.remove(progress_file)
+
     local_logger.info(f"🎉 Done. Retention rate: {len(passed_qas)}/{len(raw_qas)}")
     local_logger.flush()
 
-if __name__ == "__main__":
+async def main():
     all_files = sorted(glob.glob(os.path.join(CAPTION_DIR, "*.json")))
     target_files = all_files[START_INDEX:END_INDEX]
     
-    logger.info(f"🎯 Step 5 processing indices {START_INDEX}-{END_INDEX} (Total {len(target_files)}) with {MAX_WORKERS} threads")
+    logger.info(f"🎯 Step 5 processing indices {START_INDEX}-{END_INDEX} (Total {len(target_files)}) with {MAX_WORKERS} concurrent requests")
     
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        executor.map(process_single_video, target_files)
+    clip_slots = asyncio.Semaphore(MAX_WORKERS)
+    limiters = get_rate_limiters(MAX_WORKERS)
+    results = await asyncio.gather(*(process_single_video(f, clip_slots, limiters) for f in target_files), return_exceptions=True)
+    for caption_file, res in zip(target_files, results):
+        if isinstance(res, Exception):
+            logger.error(f"❌ Unhandled error for {caption_file}: {res}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,10 +1,27 @@
 import logging
 import os
-import json
-import time
+import re
+import sys
+import functools
+import mmap
+import asyncio
 import threading
-from openai import OpenAI
+import glob
+import orjson
+import ijson
+import httpx
+import pyarrow as pa
+import pyarrow.parquet as pq
+import contextlib
+from contextlib import AsyncExitStack
+try:
+    import fcntl
+except ImportError:  # Not available on Windows: flushes from concurrent processes are not serialized
+    fcntl = None
+from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+from aiolimiter import AsyncLimiter
 import config
+import llm_cache
 
 # ================= Common Utilities =================
 
@@ -34,12 +51,60 @@ class BufferedLogger:
                 self.logger.log(level, full_msg)
             self.buffer = []
 
-def get_openai_client():
-    if not config.API_KEY:
-        # Fallback only for testing locally if env variable not set but user edits file directly
-        # raise ValueError("API Key is missing. Please set OPEN_MODEL_API_KEY environment variable.")
-        pass
-    return OpenAI(api_key=config.API_KEY, base_url=config.API_BASE_URL)
+def _http_client_kwargs():
+    """Pool/keep-alive settings so concurrent requests reuse connections instead of re-handshaking."""
+    return {
+        "http2": config.HTTP2_ENABLED,
+        "limits": httpx.Limits(max_connections=config.HTTP_MAX_CONNECTIONS,
+                               max_keepalive_connections=config.HTTP_MAX_KEEPALIVE),
+        "timeout": httpx.Timeout(**config.HTTP_TIMEOUTS),
+    }
+
+@functools.lru_cache(maxsize=1)
+def get_async_openai_client():
+    """Returns the process-wide async client (e.g. the fused pipeline's step3 and step4 share one pool)."""
+    return AsyncOpenAI(api_key=config.API_KEY, base_url=config.API_BASE_URL,
+                       http_client=httpx.AsyncClient(**_http_client_kwargs()))
+
+class TokenLimiter(AsyncLimiter):
+    """Tokens-per-minute bucket. Charged with each request's estimated size instead of being entered as a context manager."""
+
+def get_rate_limiters(max_concurrency):
+    """Returns (semaphore, limiter, token limiter) bounding in-flight requests, requests per minute and tokens per minute."""
+    return asyncio.Semaphore(max_concurrency), AsyncLimiter(config.REQUESTS_PER_MINUTE, 60), TokenLimiter(config.TOKENS_PER_MINUTE, 60)
+
+async def acquire_limiters(stack, limiters, tokens):
+    """Enters every limiter in `limiters` on `stack`; token limiters are charged `tokens` instead."""
+    for limiter in limiters:
+        if isinstance(limiter, TokenLimiter):
+            await limiter.acquire(min(tokens, limiter.max_rate))
+        else:
+            await stack.enter_async_context(limiter)
+
+def estimate_tokens(messages, max_tokens=0):
+    """Rough request size as providers meter it: ~4 characters per prompt token plus the completion budget."""
+    chars = 0
+    for m in messages:
+        content = m["content"]
+        if isinstance(content, str):
+            chars += len(content)
+        else:
+            # Multimodal parts: only text counts; inline media is billed separately, not by its base64 length
+            chars += sum(len(part.get("text", "")) for part in content)
+    return chars // 4 + max_tokens
+
+def retry_delay(error, attempt):
+    """Seconds to wait before retry `attempt` + 1: the server's retry-after on rate limits, backoff on server errors."""
+    if isinstance(error, RateLimitError):
+        try:
+            return float(error.response.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            pass
+    if isinstance(error, (RateLimitError, APIConnectionError, InternalServerError)):
+        return config.RETRY_BASE_DELAY * 2 ** attempt
+    if isinstance(error, ValueError):
+        return 0  # Malformed output; nothing to wait out
+    return config.RETRY_BASE_DELAY
 
 
 def setup_logger(name, log_dir):
@@ -68,13 +133,141 @@ def setup_logger(name, log_dir):
     logger.addHandler(ch)
     return logger
 
+class ResultStore:
+    """
+    Single-file Parquet store of per-video QA lists (columns: video_id, qas).
+    Replaces one small JSON file per video. QA lists are kept as JSON text because their
+    fields vary between LLM outputs. put() only buffers in memory; append() also persists the
+    record at once as one line of a JSONL journal next to the store, and flush() compacts the
+    journal and buffer into the Parquet file, merging with what is on disk, so runs over
+    different video ranges can share one store. Reads replay the journal over the Parquet file.
+    With `legacy_suffix`, per-video "<video_id><legacy_suffix>" JSON files next to the store
+    are imported for videos it does not hold yet, so outputs of the old layout are reused.
+    """
+    SCHEMA = pa.schema([("video_id", pa.string()), ("qas", pa.string())])
+
+    def __init__(self, path, legacy_suffix=None):
+        self.path = path
+        self.journal_path = f"{path}.journal.jsonl"
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.records = self._read()
+        if legacy_suffix:
+            self._import_legacy(legacy_suffix)
+
+    def _read(self):
+        records = {}
+        if os.path.exists(self.path):
+            table = pq.read_table(self.path)
+            records = dict(zip(table.column("video_id").to_pylist(), table.column("qas").to_pylist()))
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        continue  # Torn trailing line from an interrupted append
+                    records[entry["video_id"]] = entry["qas"]
+        return records
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        """Exclusive lock serializing journal appends and compaction against other processes."""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f"{self.path}.lock", 'a') as lock_file:
+            if fcntl: fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _import_legacy(self, suffix):
+        for file_path in sorted(glob.glob(os.path.join(os.path.dirname(self.path), f"*{suffix}"))):
+            video_id = os.path.basename(file_path)[:-len(suffix)]
+            if video_id in self.records: continue
+            qas = load_json(file_path)
+            if qas:
+                self.put(video_id, qas)
+
+    def has(self, video_id):
+        with self.lock:
+            return video_id in self.records
+
+    def put(self, video_id, qas):
+        encoded = orjson.dumps(qas).decode('utf-8')
+        with self.lock:
+            self.records[video_id] = encoded
+
+    def append(self, video_id, qas):
+        """put() plus an immediate journal write, so the record survives a crash before flush()."""
+        encoded = orjson.dumps(qas).decode('utf-8')
+        with self.lock:
+            self.records[video_id] = encoded
+        try:
+            with self._file_lock():
+                with open(self.journal_path, 'a+b') as f:
+                    line = orjson.dumps({"video_id": video_id, "qas": encoded}) + b"\n"
+                    # Start on a fresh line if a crashed writer left a torn one behind
+                    if f.seek(0, os.SEEK_END):
+                        f.seek(-1, os.SEEK_END)
+                        if f.read(1) != b"\n":
+                            line = b"\n" + line
+                    f.write(line)
+            return True
+        except Exception as e:
+            logging.error(f"❌ Error appending to result store journal {self.journal_path}: {e}")
+            return False
+
+    def get(self, video_id):
+        with self.lock:
+            encoded = self.records.get(video_id)
+        return orjson.loads(encoded) if encoded is not None else None
+
+    def video_ids(self):
+        with self.lock:
+            return sorted(self.records)
+
+    def scan(self):
+        """Yields (video_id, qas) pairs in video_id order."""
+        for video_id in self.video_ids():
+            yield video_id, self.get(video_id)
+
+    def flush(self):
+        """
+        Compacts the store: atomically rewrites the Parquet file with the on-disk records (journal
+        included) plus every buffered one, then empties the journal.
+        """
+        with self.flush_lock:
+            try:
+                with self._file_lock():
+                    with self.lock:
+                        merged = self._read()
+                        merged.update(self.records)
+                        self.records = merged
+                        video_ids = sorted(merged)
+                        table = pa.table({"video_id": video_ids, "qas": [merged[v] for v in video_ids]}, schema=self.SCHEMA)
+                    tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                    pq.write_table(table, tmp_path)
+                    os.replace(tmp_path, self.path)
+                    if os.path.exists(self.journal_path):
+                        os.remove(self.journal_path)
+                return True
+            except Exception as e:
+                logging.error(f"❌ Error saving result store {self.path}: {e}")
+                return False
+
 def load_json(file_path):
     """Safely loads a JSON file."""
     if not os.path.exists(file_path):
         return None
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise ValueError("file is empty")
+            # Parse straight from the page cache instead of copying into a read buffer
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    return orjson.loads(view)
+                finally:
+                    view.release()
     except Exception as e:
         logging.error(f"❌ Error loading JSON {file_path}: {e}")
         return None
@@ -84,59 +277,124 @@ def save_json(data, file_path):
     try:
         # Ensure directory exists
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        with open(file_path, 'wb') as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
         return True
     except Exception as e:
         logging.error(f"❌ Error saving JSON {file_path}: {e}")
         return False
 
-def call_llm_with_retry(client, model, messages, temperature=0.1, max_tokens=4096, max_retries=3, logger=None, validator=None):
-    """Executes an LLM API call with retry logic."""
+async def async_call_llm_with_retry(client, model, messages, temperature=0.1, max_tokens=4096, max_retries=3, logger=None, validator=None, response_format=None, limiters=(), cache_messages=None):
+    """
+    Executes an LLM API call with retry logic. Validated responses are served from / stored in llm_cache.
+    Each attempt acquires every limiter in `limiters` (see acquire_limiters).
+    `cache_messages` is hashed for the cache key instead of `messages`: a light stand-in for requests with inline media.
+    """
+    extra_args = {}
+    if response_format:
+        extra_args['response_format'] = response_format
+    cache_key = llm_cache.make_key(model, cache_messages or messages, temperature=temperature, max_tokens=max_tokens, **extra_args)
+    cached = llm_cache.get(cache_key)
+    if cached is not None and (not validator or validator(cached)):
+        return cached
+    tokens = estimate_tokens(messages, max_tokens)
     for attempt in range(max_retries):
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                timeout=180 # 3 minutes timeout
-            )
+            async with AsyncExitStack() as stack:
+                await acquire_limiters(stack, limiters, tokens)
+                response = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    timeout=180, # 3 minutes timeout
+                    **extra_args
+                )
             content = response.choices[0].message.content
             
-            if validator:
-                if validator(content):
-                    return content
-                else:
-                    msg = f"Validation failed for attempt {attempt + 1}"
-                    if logger: logger.warning(f"⚠️ {msg}")
-                    # Treat as exception to trigger retry logic
-                    raise ValueError(msg)
+            if validator and not validator(content):
+                msg = f"Validation failed for attempt {attempt + 1}"
+                if logger: logger.warning(f"⚠️ {msg}")
+                # Treat as exception to trigger retry logic
+                raise ValueError(msg)
             
+            llm_cache.put(cache_key, content)
             return content
         except Exception as e:
             if logger:
                 logger.warning(f"⚠️ API Attempt {attempt + 1}/{max_retries} failed: {e}")
             if attempt < max_retries - 1:
-                time.sleep(2)
+                await asyncio.sleep(retry_delay(e, attempt))
             else:
                 if logger:
                     logger.error(f"❌ API Final Failure: {e}")
                 return None
 
+async def run_batch_job(client, requests, work_dir, logger=None):
+    """
+    Runs chat-completion requests through the provider Batch API (half price, completes within 24h).
+    `requests` is a list of (custom_id, body). Returns {custom_id: content} for every request that succeeded.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    batches = []
+    for start in range(0, len(requests), config.BATCH_MAX_REQUESTS):
+        chunk = requests[start:start + config.BATCH_MAX_REQUESTS]
+        input_path = os.path.join(work_dir, f"batch_input_{start // config.BATCH_MAX_REQUESTS}.jsonl")
+        with open(input_path, 'wb') as f:
+            for custom_id, body in chunk:
+                f.write(orjson.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) + b"\n")
+        with open(input_path, 'rb') as f:
+            batch_file = await client.files.create(file=f, purpose="batch")
+        batch = await client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        if logger: logger.info(f"📦 Submitted batch {batch.id} with {len(chunk)} requests")
+        batches.append(batch)
+
+    results = {}
+    for batch in batches:
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(config.BATCH_POLL_SECONDS)
+            batch = await client.batches.retrieve(batch.id)
+        if logger: logger.info(f"📦 Batch {batch.id} finished with status {batch.status}")
+        # Expired batches still deliver the requests that completed in time
+        if not batch.output_file_id: continue
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip(): continue
+            record = orjson.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200: continue
+            try:
+                results[record["custom_id"]] = response["body"]["choices"][0]["message"]["content"]
+            except (KeyError, IndexError, TypeError):
+                continue
+    return results
+
+# Outermost {...} span of a response (first '{' to last '}'), e.g. inside a markdown fence
+JSON_OBJ_RE = re.compile(r'\{.*\}', re.DOTALL)
+
+@functools.lru_cache(maxsize=256)
+def _parse_json_text(text):
+    """
+    Parses an LLM response once: the whole text, else its outermost {...} span.
+    Memoized so validate_json_obj and the caller's parse_json_from_response share a single parse;
+    the returned object is shared, so treat it as read-only.
+    """
+    try:
+        return orjson.loads(text)
+    except orjson.JSONDecodeError:
+        pass
+    match = JSON_OBJ_RE.search(text)
+    if match:
+        try:
+            return orjson.loads(match.group())
+        except orjson.JSONDecodeError:
+            pass
+    return None
+
 def parse_json_from_response(text):
     """Extracts and parses JSON object from LLM response text."""
     if not text: return None
-    try:
-        # Try direct parse
-        return json.loads(text)
-    except json.JSONDecodeError:
-        # Try stripping markdown
-        clean_text = text.replace("```json", "").replace("```", "").strip()
-        try:
-            return json.loads(clean_text)
-        except json.JSONDecodeError:
-            return None
+    return _parse_json_text(text)
 
 def validate_json_list(text):
     """Checks if the response contains a valid JSON list."""
@@ -147,7 +405,7 @@ def validate_json_list(text):
         end = text.rfind(']')
         if start != -1 and end != -1 and end > start:
             candidate = text[start:end+1]
-            json.loads(candidate)
+            orjson.loads(candidate)
             return True
         return False
     except:
@@ -156,20 +414,60 @@ def validate_json_list(text):
 def validate_json_obj(text):
     """Checks if the response contains a valid JSON object."""
     if not text: return False
+    return isinstance(_parse_json_text(text), dict)
+
+def iter_json_array(file_path):
+    """Incrementally yields the elements of a top-level JSON array without materializing the list."""
+    if not os.path.exists(file_path):
+        return
     try:
-        # Try to find the first '{' and last '}'
-        start = text.find('{')
-        end = text.rfind('}')
-        if start != -1 and end != -1 and end > start:
-            candidate = text[start:end+1]
-            json.loads(candidate)
-            return True
-        return False
-    except:
-        return False
+        with open(file_path, 'rb') as f:
+            yield from ijson.items(f, 'item')
+    except Exception as e:
+        logging.error(f"❌ Error streaming JSON {file_path}: {e}")
+
+def iter_jsonl(file_path):
+    """Yields one parsed record per non-empty line of a JSON Lines file."""
+    if not os.path.exists(file_path):
+        return
+    try:
+        with open(file_path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+    except Exception as e:
+        logging.error(f"❌ Error reading JSONL {file_path}: {e}")
 
 def load_captions_map(file_path):
-    """Loads a caption file and returns a {slice_num: caption} dictionary."""
-    data = load_json(file_path)
-    if not data: return {}
-    return {item.get('slice_num'): item.get('cap') for item in data}
+    """
+    Loads a caption file into a slice_num -> caption map with int keys and interned captions.
+    Dense slice numbers (at most half padding) give a list indexed by slice_num, padded with "";
+    sparse ones fall back to a dict. Read it through get_caption(), which handles both.
+    """
+    captions = {}
+    for item in iter_json_array(file_path):
+        sid, cap = item.get('slice_num'), item.get('cap')
+        if sid is None or not cap: continue
+        try:
+            captions[int(sid)] = sys.intern(cap)
+        except (TypeError, ValueError):
+            continue
+    if not captions: return captions
+
+    lo, hi = min(captions), max(captions)
+    if lo < 0 or hi >= 2 * len(captions): return captions
+    dense = [""] * (hi + 1)
+    for sid, cap in captions.items():
+        dense[sid] = cap
+    return dense
+
+def get_caption(caption_map, sid):
+    """Caption for one slice id from a load_captions_map() result, "" if missing."""
+    if isinstance(caption_map, list):
+        return caption_map[sid] if type(sid) is int and 0 <= sid < len(caption_map) else ""
+    return caption_map.get(sid) or ""
+
+def iter_captions(caption_map):
+    """Yields every non-empty caption of a load_captions_map() result."""
+    values = caption_map if isinstance(caption_map, list) else caption_map.values()
+    return (cap for cap in values if cap)